@@ -0,0 +1,70 @@
+"""Compare the single-pass xlsx writer with the old write–reload–save path.
+
+Usage: python benchmarks/bench_escritura.py [filas]
+"""
+import os
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from silice_engine import escribir_excel
+
+
+def frame_salida(filas, seed=0):
+    """Processed-looking frame with the output columns of procesar_xls."""
+    rng = np.random.default_rng(seed)
+    referencias = np.array(['E-IPA-44', 'E-LAG-33', 'E-KEG-20', 'E-KEG-30', 'E-STO-37'])
+    cantidad = rng.integers(1, 200, filas).astype(float)
+    precio = rng.uniform(0.5, 90, filas).round(2)
+    return pd.DataFrame({
+        'Almacén': rng.choice(['01', '02', '03'], filas),
+        'Fecha': pd.Timestamp('2025-01-01') + pd.to_timedelta(rng.integers(0, 365, filas), unit='D'),
+        'Referencia': rng.choice(referencias, filas),
+        'Descripción': rng.choice(['CERVEZA IPA 6% ABV', 'LAGER 4.5% ABV', 'STOUT 7% ABV'], filas),
+        'Concepto': rng.choice(['SALIDA POR FACTURA', 'ENTRADA POR ABONO EN FACTURA'], filas),
+        'Documento': rng.integers(10000, 99999, filas),
+        'Cliente / Prov.': rng.integers(1, 5000, filas),
+        'Cantidad': cantidad,
+        'Precio': precio,
+        'LOT': [f"{a}-{b:03d}" for a, b in zip(rng.integers(20, 26, filas), rng.integers(0, 1000, filas))],
+        'LITRES': cantidad * 0.44,
+        'VALOR': cantidad * precio,
+    })
+
+
+def escritura_anterior(df, destino):
+    df.to_excel(destino, index=False)
+    wb = load_workbook(destino)
+    ws = wb.active
+    ws.freeze_panes = 'A2'
+    ws.auto_filter.ref = ws.dimensions
+    wb.save(destino)
+
+
+def cronometrar(funcion, *args):
+    inicio = time.perf_counter()
+    funcion(*args)
+    return time.perf_counter() - inicio
+
+
+def main(filas=100_000):
+    df = frame_salida(filas)
+    with tempfile.TemporaryDirectory() as tmp:
+        anterior = cronometrar(escritura_anterior, df, os.path.join(tmp, 'anterior.xlsx'))
+        nueva = cronometrar(escribir_excel, df, os.path.join(tmp, 'nueva.xlsx'))
+    memoria = cronometrar(escribir_excel, df, BytesIO())
+
+    print(f"{filas} filas")
+    print(f"  to_excel + load_workbook + save: {anterior:8.2f} s")
+    print(f"  escribir_excel (fichero):        {nueva:8.2f} s  ({anterior / nueva:.1f}x)")
+    print(f"  escribir_excel (BytesIO):        {memoria:8.2f} s")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
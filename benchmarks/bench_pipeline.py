@@ -0,0 +1,139 @@
+"""Time each stage of procesar_xls on synthetic SILICE exports.
+
+Stages: read, header detection, row combining with the LOT search,
+filtering, numeric parsing, litres/value and the xlsx, Parquet and CSV
+writes. Each stage records its wall time, the rows going in and out and
+(unless --sin-memoria) the peak memory allocated while it runs. Results are
+written to a JSON file so runs on different commits can be compared with
+--comparar. Generating the .xls exports needs xlwt (pip install -r
+benchmarks/requirements.txt).
+
+Usage: python benchmarks/bench_pipeline.py [--filas 1000 10000 ...] [--formatos xlsx xls]
+                                           [--salida bench_resultados.json] [--comparar ANTERIOR.json]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from io import BytesIO
+
+import pandas as pd
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import silice_proceso as cli
+from generador_silice import MAX_FILAS_XLS, generar_fichero
+from silice_engine import FiltroReglas, Perfil, calcular_agregados, combinar_tabla, escribir_excel, escribir_salida, localizar_cabecera
+
+TAMANOS = [1_000, 10_000, 100_000, 1_000_000]
+
+
+def ejecutar(entrada, memoria=True):
+    """Run the pipeline stage by stage on ``entrada`` and return the stage records."""
+    perfil = Perfil(memoria=memoria)
+
+    def etapa(nombre, funcion, *args, filas_entrada=None, filas_salida=len):
+        with perfil.etapa(nombre, filas_entrada) as registro:
+            resultado = funcion(*args)
+        if filas_salida:
+            registro['filas_salida'] = filas_salida(resultado)
+        return resultado
+
+    df = etapa('lectura', lambda: pd.read_excel(entrada, header=None))
+    columnas, header_row = etapa('cabecera', localizar_cabecera, df,
+                                 filas_entrada=len(df), filas_salida=None)
+    filtro = FiltroReglas(cli.REGLAS, cli.CAMPOS_REGLAS)
+    combinadas = etapa('combinar_lotes', lambda: combinar_tabla(
+        df, cli.construir_tabla, cabecera=(columnas, header_row), filtro=filtro, columna_fila=cli.COLUMNA_FILA),
+        filas_entrada=len(df))
+    filtradas = etapa('filtrado', cli.filtrar_resultado, combinadas, filas_entrada=len(combinadas))
+    numericas = etapa('numeros', lambda: cli.convertir_numericos(filtradas)[0], filas_entrada=len(filtradas))
+    final = etapa('litros', cli.calcular_importes, numericas, filas_entrada=len(numericas))
+    _, resumenes = etapa('agregados', calcular_agregados, final, filas_entrada=len(final), filas_salida=None)
+    etapa('escritura', lambda: escribir_excel(final, BytesIO(), hojas_extra=resumenes), filas_entrada=len(final), filas_salida=None)
+    for formato in ('parquet', 'csv'):
+        etapa(f'escritura_{formato}', lambda: escribir_salida(final, BytesIO(), formato), filas_entrada=len(final), filas_salida=None)
+    return [{**registro, 'segundos': round(registro['segundos'], 4),
+             'pico_mb': None if registro['pico_mb'] is None else round(registro['pico_mb'], 2)}
+            for registro in perfil.etapas]
+
+
+def version_repo():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=RAIZ,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def comparar(actual, anterior):
+    """Print the time ratio of every stage against a previous results file."""
+    previos = {(r['formato'], r['filas'], e['etapa']): e for r in anterior['resultados'] for e in r['etapas']}
+    print(f"\nComparación con {anterior.get('commit') or 'resultado anterior'}:")
+    for r in actual['resultados']:
+        for e in r['etapas']:
+            previo = previos.get((r['formato'], r['filas'], e['etapa']))
+            if previo and previo['segundos']:
+                print(f"  {r['formato']:5} {r['filas']:>9} {e['etapa']:15} "
+                      f"{previo['segundos']:9.3f} s -> {e['segundos']:9.3f} s  ({e['segundos'] / previo['segundos']:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mide cada etapa del procesamiento sobre exportaciones sintéticas.")
+    parser.add_argument('--filas', type=int, nargs='+', default=TAMANOS[:3],
+                        help=f"Tamaños de las exportaciones en filas (por defecto, {TAMANOS[:3]}; hasta {TAMANOS[-1]}).")
+    parser.add_argument('--formatos', nargs='+', default=['xlsx', 'xls'], choices=['xlsx', 'xls'])
+    parser.add_argument('--semilla', type=int, default=0)
+    parser.add_argument('--datos', help="Directorio donde guardar y reutilizar las exportaciones generadas.")
+    parser.add_argument('--sin-memoria', action='store_true', help="No mide la memoria (tracemalloc ralentiza las etapas).")
+    parser.add_argument('--salida', default='bench_resultados.json')
+    parser.add_argument('--comparar', metavar='ANTERIOR.json')
+    args = parser.parse_args()
+
+    datos = args.datos or tempfile.mkdtemp(prefix='bench_silice_')
+    os.makedirs(datos, exist_ok=True)
+    informe = {
+        'commit': version_repo(),
+        'fecha': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'memoria': not args.sin_memoria,
+        'resultados': [],
+    }
+    for formato in args.formatos:
+        for filas in args.filas:
+            if formato == 'xls' and filas > MAX_FILAS_XLS:
+                print(f"xls {filas}: omitido (un .xls admite como máximo {MAX_FILAS_XLS} filas)")
+                continue
+            entrada = os.path.join(datos, f"silice_{filas}_{args.semilla}.{formato}")
+            if not os.path.exists(entrada):
+                try:
+                    generar_fichero(filas, entrada, args.semilla)
+                except RuntimeError as e:
+                    print(f"{formato} {filas}: omitido ({e})")
+                    continue
+            etapas = ejecutar(entrada, memoria=not args.sin_memoria)
+            informe['resultados'].append({'formato': formato, 'filas': filas, 'etapas': etapas})
+            total = sum(e['segundos'] for e in etapas)
+            print(f"{formato} {filas} filas: {total:.2f} s")
+            for e in etapas:
+                pico = '' if e['pico_mb'] is None else f"{e['pico_mb']:9.1f} MB"
+                filas_es = '' if e['filas_salida'] is None else f"{e['filas_entrada'] or ''} -> {e['filas_salida']} filas"
+                print(f"  {e['etapa']:15} {e['segundos']:9.3f} s {pico}  {filas_es}")
+
+    with open(args.salida, 'w', encoding='utf-8') as f:
+        json.dump(informe, f, ensure_ascii=False, indent=2)
+    print(f"Resultados guardados en: {args.salida}")
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            comparar(informe, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""Synthetic SILICE movement exports for the benchmarks.
+
+The ledgers mimic the ERP export: repeated page headers ("Movimientos:",
+"Página N" and the column header row), product rows with E… references,
+LOT lines at varying distances after their product, products without LOT,
+notes and blank lines.
+
+Usage: python benchmarks/generador_silice.py FILAS SALIDA.xlsx|SALIDA.xls [--semilla N]
+"""
+import argparse
+import datetime
+import os
+import random
+
+from openpyxl import Workbook
+
+CABECERA = ['Almacén', 'Fecha', 'Referencia', 'Descripción', None, 'Concepto', None,
+            'Documento', 'Cliente / Prov.', 'Cantidad', 'Precio']
+ANCHO = len(CABECERA)
+
+# Rows per printed page of the export
+FILAS_PAGINA = 60
+
+# .xls sheets cannot hold more rows than this
+MAX_FILAS_XLS = 65536
+
+REFERENCIAS = ['E-IPA-44', 'E-LAG-33', 'E-LAG-33C', 'E-KEG-20', 'E-KEG-20I', 'E-KEG-30', 'E-STO-37',
+               'E-BAR-10', 'E-PIL-44', 'E-ESP-99', 'PALET', 'CAJA-VACIA']
+DESCRIPCIONES = ['CERVEZA IPA 6,5% ABV', 'LAGER 4,5% ABV', 'BARRIL LAGER 5% ABV', 'STOUT 7% ABV',
+                 'ENVASE RETORNABLE', 'PALET EUROPEO']
+CONCEPTOS = ['Salida por Factura'] * 6 + ['Entrada por abono en Factura'] * 2 + [
+    'Salida por Intercambio', 'Regularización de inventario', 'Entrada por compra']
+
+
+def _fila(*valores):
+    fila = list(valores) + [None] * (ANCHO - len(valores))
+    return tuple(fila)
+
+
+def generar_filas(filas, semilla=0):
+    """Yield ``filas`` rows of a synthetic export (tuples of cell values)."""
+    rnd = random.Random(semilla)
+    inicio = datetime.datetime(2025, 1, 1)
+    emitidas = 0
+    pagina = 0
+    en_pagina = FILAS_PAGINA
+    documento = 100000
+
+    def cabecera_pagina():
+        nonlocal pagina
+        pagina += 1
+        return [
+            _fila(f"Movimientos: 01/01/2025 - 31/12/2025"),
+            _fila(*([None] * 9), f"Página {pagina}"),
+            tuple(CABECERA),
+        ]
+
+    referencia = rnd.choice(REFERENCIAS)
+    while emitidas < filas:
+        bloque = []
+        if rnd.random() > 0.1:
+            referencia = rnd.choice(REFERENCIAS)
+        documento += rnd.randint(0, 2)
+        cantidad = rnd.choice([rnd.randint(-240, -1), rnd.randint(1, 240), f"{rnd.randint(1, 99)},5"])
+        precio = rnd.choice([round(rnd.uniform(0.4, 120), 2), f"{rnd.randint(1, 99)},{rnd.randint(0, 99):02d}"])
+        bloque.append(_fila(
+            rnd.choice(['01', '02', '03']),
+            inicio + datetime.timedelta(days=rnd.randint(0, 364)),
+            referencia,
+            rnd.choice(DESCRIPCIONES),
+            rnd.choice([None, None, 'ABV']),
+            rnd.choice(CONCEPTOS),
+            None,
+            f"FV{documento}",
+            rnd.choice([rnd.randint(1, 9999), None, '2734']),
+            cantidad,
+            precio,
+        ))
+
+        # LOT line at a varying distance, sometimes missing altogether
+        for _ in range(rnd.choice([0, 0, 0, 1, 2, 4])):
+            bloque.append(_fila() if rnd.random() < 0.6 else _fila(None, None, None, 'Observaciones del movimiento'))
+        if rnd.random() < 0.85:
+            lote = f"{rnd.randint(20, 25)}{rnd.choice(['-', '-', ' '])}{rnd.randint(0, 999):03d}"
+            columna = rnd.choice([3, 3, 4, 7])
+            linea = [None] * ANCHO
+            linea[columna] = rnd.choice(['Lote: ', 'LOT ', '']) + lote
+            bloque.append(tuple(linea))
+        if rnd.random() < 0.3:
+            bloque.append(_fila())
+
+        for fila in bloque:
+            if en_pagina >= FILAS_PAGINA:
+                for linea in cabecera_pagina():
+                    if emitidas < filas:
+                        yield linea
+                        emitidas += 1
+                en_pagina = 0
+            if emitidas >= filas:
+                return
+            yield fila
+            emitidas += 1
+            en_pagina += 1
+
+
+def escribir_xlsx(ruta, filas):
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Movimientos')
+    for fila in filas:
+        ws.append(fila)
+    wb.save(ruta)
+
+
+def escribir_xls(ruta, filas):
+    try:
+        import xlwt
+    except ImportError:
+        raise RuntimeError("Generar ficheros .xls requiere el paquete xlwt (pip install xlwt).")
+    libro = xlwt.Workbook()
+    hoja = libro.add_sheet('Movimientos')
+    estilo_fecha = xlwt.easyxf(num_format_str='DD/MM/YYYY')
+    for r, fila in enumerate(filas):
+        if r >= MAX_FILAS_XLS:
+            raise ValueError(f"Un fichero .xls admite como máximo {MAX_FILAS_XLS} filas.")
+        for c, valor in enumerate(fila):
+            if valor is None:
+                continue
+            if isinstance(valor, datetime.datetime):
+                hoja.write(r, c, valor, estilo_fecha)
+            else:
+                hoja.write(r, c, valor)
+    libro.save(ruta)
+
+
+def generar_fichero(filas, ruta, semilla=0):
+    """Write a synthetic export with ``filas`` rows to ``ruta`` (.xls or .xlsx)."""
+    escribir = escribir_xls if os.path.splitext(ruta)[1].lower() == '.xls' else escribir_xlsx
+    escribir(ruta, generar_filas(filas, semilla))
+    return ruta
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Genera una exportación sintética de movimientos SILICE.")
+    parser.add_argument('filas', type=int)
+    parser.add_argument('salida')
+    parser.add_argument('--semilla', type=int, default=0)
+    args = parser.parse_args()
+    generar_fichero(args.filas, args.salida, args.semilla)
+    print(f"Generado {args.salida} ({args.filas} filas)")
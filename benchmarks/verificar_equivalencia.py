@@ -0,0 +1,255 @@
+"""Check that the engine finds the same records and LOTs as the original scan.
+
+The original procesar_xls located the header with a row-by-row scan and,
+for every product row, searched the following rows for its LOT. That scan
+is reproduced here and compared, on synthetic exports from
+generador_silice, with:
+
+- the header found by localizar_cabecera;
+- combinar_tabla on the in-memory sheet, for several block sizes;
+- combinar_tabla streaming the workbook with iterar_filas;
+- combinar_en_paralelo, cutting the sheet at cortes_seguros into several chunks;
+- the incremental mode: an export processed in two runs (a shorter earlier
+  export, then the full one, resumed where the first run left off) must
+  give the output of a single full run, in memory and streaming, and so
+  must the CSV output appended in place.
+
+A ledger grouped by article, one long run of a single E… reference with
+no LOT line until the end, is checked too: against the original scan on a
+short run, and on a long one (--misma-referencia products, whose LOTs are
+known) with its time, since that is where a per-product search turns
+quadratic.
+
+Exits with status 1 if any check differs.
+
+Usage: python benchmarks/verificar_equivalencia.py [--filas 5000 20000] [--semillas 0 1 2]
+                                                   [--bloques 200 999 50000] [--procesos 2 3 5]
+                                                   [--misma-referencia 50000]
+"""
+import argparse
+import os
+import re
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import silice_engine
+import silice_proceso as cli
+from generador_silice import CABECERA, escribir_xlsx, generar_filas
+from silice_engine import PuntoControl, combinar_en_paralelo, combinar_tabla, cortes_seguros, iterar_filas, localizar_cabecera
+
+# Keywords of the original header scan (the first cell containing them wins)
+CLAVES_ORIGINALES = {
+    'Almacén': ['almacén'],
+    'Fecha': ['fecha'],
+    'Referencia': ['referencia'],
+    'Descripción': ['descripción'],
+    'Concepto': ['concepto'],
+    'Documento': ['documento'],
+    'Cliente / Prov.': ['cliente', 'prov'],
+    'Cantidad': ['cantidad'],
+    'Precio': ['precio'],
+}
+HEADER_ORIGINAL = re.compile(r'^(movimientos:|almacén|página|fecha|referencia)', re.IGNORECASE)
+
+
+def cabecera_original(valores):
+    """Header columns and row as the original cell-by-cell scan found them."""
+    columnas = dict.fromkeys(CLAVES_ORIGINALES)
+    for fila, celdas in enumerate(valores):
+        for columna, valor in enumerate(celdas):
+            if pd.notnull(valor):
+                texto = str(valor).strip().lower()
+                for campo, claves in CLAVES_ORIGINALES.items():
+                    if columnas[campo] is None and all(clave in texto for clave in claves):
+                        columnas[campo] = columna
+        if all(columna is not None for columna in columnas.values()):
+            return columnas, fila
+    raise ValueError("No se pudieron identificar todas las columnas requeridas.")
+
+
+def escaneo_original(df):
+    """Header and ``[(posición, referencia, LOT)]`` of every product row, by the original forward scan."""
+    valores = df.to_numpy(dtype=object)
+    columnas, header_row = cabecera_original(valores)
+    col_ref = columnas['Referencia']
+    registros = []
+    for indice, fila in enumerate(valores):
+        if not pd.notnull(fila[col_ref]):
+            continue
+        referencia = str(fila[col_ref]).strip().upper()
+        lote = None
+        for siguiente in valores[indice + 1:]:
+            primera = ''
+            for valor in siguiente:
+                if pd.notnull(valor):
+                    primera = str(valor).strip()
+                    break
+            if HEADER_ORIGINAL.search(primera) or primera == '':
+                continue
+            ref = str(siguiente[col_ref]).strip().lower() if pd.notnull(siguiente[col_ref]) else ''
+            if ref and ref.startswith('e') and ref != referencia.lower():
+                break
+            for valor in siguiente:
+                encontrado = re.search(r'(\d{2}[-\s]\d{3})', str(valor).strip().upper())
+                if encontrado:
+                    lote = re.sub(r'\s+', '', encontrado.group(1))
+                    break
+            if lote:
+                break
+        registros.append((indice, referencia, lote or ''))
+    return (columnas, header_row), registros
+
+
+def construir_referencias(valores, columnas):
+    return pd.DataFrame({'Referencia': pd.Series(valores[:, columnas['Referencia']], dtype=object).map(str).str.strip().str.upper()})
+
+
+def registros_motor(df):
+    return list(zip(df['Fila'].tolist(), df['Referencia'].tolist(), df['LOT'].astype(str).tolist()))
+
+
+def diferencias(esperado, obtenido):
+    """Number of differing records and the first one, or (0, None)."""
+    if esperado == obtenido:
+        return 0, None
+    distintos = [(a, b) for a, b in zip(esperado, obtenido) if a != b]
+    distintos += [(a, None) for a in esperado[len(obtenido):]] + [(None, b) for b in obtenido[len(esperado):]]
+    return len(distintos), distintos[0]
+
+
+def salida_comparable(df):
+    # Categories differ between runs, so compare the cells as text
+    return df.reset_index(drop=True).astype(str)
+
+
+def ejecutar_incremental(entrada, salida, streaming):
+    """One incremental run writing ``salida`` (CSV) and its checkpoint, as the CLI does."""
+    punto_control = PuntoControl(cli.ruta_punto_control(salida))
+    df, _ = cli.calcular_resultado(entrada, streaming=streaming, punto_control=punto_control)
+    cli.escribir_resultado(df, salida, {}, punto_control)
+    return df, punto_control.filas_previas
+
+
+def verificar_incremental(filas, ruta_completa, directorio, cortes):
+    """Full run vs. a run on the first ``corte`` rows followed by an incremental run on all of them.
+
+    Returns ``(corte, streaming, ok, checkpointed rows reused)`` per run.
+    """
+    completa, _ = cli.calcular_resultado(ruta_completa)
+    ruta_csv = os.path.join(directorio, 'completa.csv')
+    cli.escribir_salida(completa, ruta_csv, 'csv')
+    csv_completo = pd.read_csv(ruta_csv, dtype=str, keep_default_na=False)
+    resultados = []
+    for corte in cortes:
+        ruta_previa = os.path.join(directorio, f'previa_{corte}.xlsx')
+        escribir_xlsx(ruta_previa, filas[:corte])
+        for streaming in (False, True):
+            salida = os.path.join(directorio, f'incremental_{corte}_{streaming}.csv')
+            ejecutar_incremental(ruta_previa, salida, streaming)
+            incremental, reutilizadas = ejecutar_incremental(ruta_completa, salida, streaming)
+            ok = (salida_comparable(completa).equals(salida_comparable(incremental))
+                  and csv_completo.equals(pd.read_csv(salida, dtype=str, keep_default_na=False)))
+            resultados.append((corte, streaming, ok, reutilizadas))
+    return resultados
+
+
+def verificar(filas, semilla, bloques, procesos, directorio):
+    """Run every check on one synthetic export.
+
+    Returns the number of product rows and ``[(check, differences, first difference)]``.
+    """
+    generadas = list(generar_filas(filas, semilla))
+    ruta = os.path.join(directorio, f'silice_{filas}_{semilla}.xlsx')
+    escribir_xlsx(ruta, generadas)
+    df = pd.read_excel(ruta, header=None)
+
+    cabecera, esperado = escaneo_original(df)
+    detectada = localizar_cabecera(df)
+    resultados = [('cabecera', int(detectada != cabecera), f"{detectada} en lugar de {cabecera}")]
+
+    for tamano in bloques:
+        obtenido = registros_motor(combinar_tabla(df, construir_referencias, tamano_bloque=tamano, columna_fila='Fila'))
+        resultados.append((f'en memoria, bloques de {tamano}', *diferencias(esperado, obtenido)))
+
+    obtenido = registros_motor(combinar_tabla(iterar_filas(ruta), construir_referencias, columna_fila='Fila'))
+    resultados.append(('streaming', *diferencias(esperado, obtenido)))
+
+    for n in procesos:
+        partes = len(cortes_seguros(df, cabecera[0]['Referencia'], n)) + 1
+        obtenido = registros_motor(combinar_en_paralelo(df, construir_referencias, cabecera, n, columna_fila='Fila'))
+        resultados.append((f'paralelo, {n} procesos ({partes} trozos)', *diferencias(esperado, obtenido)))
+
+    # Earlier exports end at arbitrary rows, often between a product and its LOT line
+    cortes = sorted({filas // 3, filas // 2 + 1, filas - 3})
+    for corte, streaming, ok, reutilizadas in verificar_incremental(generadas, ruta, directorio, cortes):
+        modo = 'streaming' if streaming else 'en memoria'
+        resultados.append((f'incremental {modo}, previa de {corte} filas ({reutilizadas} reutilizadas)', 0 if ok else 1, None))
+    return len(esperado), resultados
+
+
+def hoja_misma_referencia(productos, referencia='E-KEG-20', lote='24-118'):
+    """Header, ``productos`` rows of one reference and a single LOT line at the end."""
+    producto = ('01', datetime(2025, 1, 1), referencia, 'BARRIL LAGER 5% ABV', None, 'Salida por Factura', None,
+                'FV100000', 1, 2, 3.5)
+    linea_lote = (None, None, None, f'Lote: {lote}') + (None,) * (len(CABECERA) - 4)
+    return pd.DataFrame([tuple(CABECERA)] + [producto] * productos + [linea_lote])
+
+
+def verificar_misma_referencia(corta, larga, bloques):
+    """Long runs of one reference without LOT lines; returns ``[(check, differences, first difference)]``."""
+    df = hoja_misma_referencia(corta)
+    _, esperado = escaneo_original(df)
+    resultados = []
+    for tamano in bloques:
+        obtenido = registros_motor(combinar_tabla(df, construir_referencias, tamano_bloque=tamano, columna_fila='Fila'))
+        resultados.append((f'{corta} productos, bloques de {tamano}', *diferencias(esperado, obtenido)))
+
+    # Every product waits for the LOT line at the end; the header row is closed by the first of them
+    df = hoja_misma_referencia(larga)
+    esperado = [(0, 'REFERENCIA', '')] + [(fila, 'E-KEG-20', '24-118') for fila in range(1, larga + 1)]
+    inicio = time.perf_counter()
+    obtenido = registros_motor(combinar_tabla(df, construir_referencias, columna_fila='Fila'))
+    segundos = time.perf_counter() - inicio
+    resultados.append((f'{larga} productos ({segundos:.2f} s)', *diferencias(esperado, obtenido)))
+    return resultados
+
+
+def informar(titulo, resultados):
+    """Print the checks of one sheet; returns how many differ."""
+    print(titulo)
+    for nombre, distintos, detalle in resultados:
+        print(f"  {nombre:<40} " + (f"{distintos} DIFERENCIAS (primera: {detalle})" if distintos else 'OK'))
+    return sum(bool(distintos) for _, distintos, _ in resultados)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--filas', type=int, nargs='+', default=[5_000, 20_000])
+    parser.add_argument('--semillas', type=int, nargs='+', default=[0, 1, 2])
+    parser.add_argument('--bloques', type=int, nargs='+', default=[200, 999, silice_engine.TAMANO_BLOQUE])
+    parser.add_argument('--procesos', type=int, nargs='+', default=[2, 3, 5])
+    parser.add_argument('--misma-referencia', type=int, default=50_000)
+    args = parser.parse_args()
+
+    # Let the synthetic sheets be cut into every requested number of chunks
+    silice_engine.FILAS_MINIMAS_TROZO = min(args.filas) // (2 * max(args.procesos))
+
+    fallos = informar("Una sola referencia sin LOT hasta el final",
+                      verificar_misma_referencia(600, args.misma_referencia, args.bloques))
+    with tempfile.TemporaryDirectory() as tmp:
+        for filas in args.filas:
+            for semilla in args.semillas:
+                productos, resultados = verificar(filas, semilla, args.bloques, args.procesos, tmp)
+                fallos += informar(f"{filas} filas, semilla {semilla} ({productos} filas de producto)", resultados)
+    print("Equivalentes." if not fallos else f"{fallos} comprobaciones con diferencias.")
+    sys.exit(1 if fallos else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,238 +1,121 @@
-import pandas as pd
-import re
+import argparse
 import os
 import sys
-from openpyxl import load_workbook
+from silice_opciones import ARCHIVO_LITROS, ARCHIVO_TRAZABILIDAD, DIRECTORIO_CACHE, FORMATOS_SALIDA, INTERVALO_VIGILANCIA, MAX_MB_CACHE
 
-# Define the function to get litres based on the reference and concept
-def get_litres_referencia(referencia, concepto):
-    if not isinstance(referencia, str):
-        return 0.0
-    
-    # Convert reference to uppercase
-    referencia = referencia.upper()
-    
-    def extract_suffix(ref):
-        # Use regular expression to find the suffix
-        match = re.search(r'(\d+)[CI]?$', ref.strip().replace(' ', ''))
-        return match.group(1) if match else ""
-    
-    suffix = extract_suffix(referencia)
-    
-    # Define the mapping between suffixes and litres
-    mapping = {
-        '10': 10.0,
-        '20': 20.0,
-        '30': 30.0,
-        '44': 0.44,
-        '33': 0.33,
-        '33C': 0.33,
-        '44C': 0.44,
-        '37': 0.37,
-        '20I': 20.0,  # Specific case for 20I
-        '30I': 30.0,  # Specific case for 30I
-        '33C': 0.33,  # Specific case for 33C
-    }
-    
-    # Return the corresponding litres or default to 0
-    return mapping.get(suffix, 0.0) if suffix else 0.0
+# The processing (silice_proceso, and with it pandas and the engine) is only
+# imported once the arguments are parsed and the input found, so --help and
+# usage errors answer at once
 
-def procesar_xls(entrada, salida):
-    try:
-        # Read the input file into a DataFrame
-        df = pd.read_excel(entrada, header=None)
-        
-        # Define the required columns
-        columnas = {
-            'Almacén': None,
-            'Fecha': None,
-            'Referencia': None,
-            'Descripción': None,
-            'Concepto': None,
-            'Documento': None,
-            'Cliente / Prov.': None,
-            'Cantidad': None,
-            'Precio': None,
-        }
-        
-        header_identified = False
-        header_row = -1
-        for idx, row in df.iterrows():
-            for col_idx, value in enumerate(row):
-                # Check each cell for header keywords
-                if pd.notnull(value):
-                    value_str = str(value).strip().lower()
-                    if columnas['Almacén'] is None and 'almacén' in value_str:
-                        columnas['Almacén'] = col_idx
-                    if columnas['Fecha'] is None and 'fecha' in value_str:
-                        columnas['Fecha'] = col_idx
-                    if columnas['Referencia'] is None and 'referencia' in value_str:
-                        columnas['Referencia'] = col_idx
-                    if columnas['Descripción'] is None and 'descripción' in value_str:
-                        columnas['Descripción'] = col_idx
-                    if columnas['Concepto'] is None and 'concepto' in value_str:
-                        columnas['Concepto'] = col_idx
-                    if columnas['Documento'] is None and 'documento' in value_str:
-                        columnas['Documento'] = col_idx
-                    if columnas['Cliente / Prov.'] is None and 'cliente' in value_str and 'prov' in value_str:
-                        columnas['Cliente / Prov.'] = col_idx
-                    if columnas['Cantidad'] is None and 'cantidad' in value_str:
-                        columnas['Cantidad'] = col_idx
-                    if columnas['Precio'] is None and 'precio' in value_str:
-                        columnas['Precio'] = col_idx
-            
-            # Check if all columns have been identified
-            if all(col is not None for col in columnas.values()):
-                header_row = idx
-                header_identified = True
-                break
-        
-        if not header_identified:
-            raise ValueError("No se pudieron identificar todas las columnas requeridas.")
-        
-        # Process each row to combine data and extract LOT
-        filas_combinadas = []
-        temp_fila = None
-        lot = None
-        lot_found = False
-        header_pattern = re.compile(r'^(movimientos:|almacén|página|fecha|referencia)', re.IGNORECASE)
-        
-        for index, row in df.iterrows():
-            # Check if the current row is part of a product's data
-            is_product_row = pd.notnull(row[columnas['Referencia']]) if columnas['Referencia'] is not None else False
-            
-            # Process rows with a valid reference
-            if is_product_row:
-                # Extract values from current row
-                cliente = 0
-                try:
-                    cliente_str = str(row[columnas['Cliente / Prov.']]).replace("nan", "0").replace(",", ".").strip()
-                    cliente = int(float(cliente_str))
-                except:
-                    pass
-                
-                cantidad = 0.0
-                try:
-                    cantidad_str = str(row[columnas['Cantidad']]).replace(",", ".").strip()
-                    cantidad = float(cantidad_str)
-                except:
-                    pass
-                
-                precio = 0.0
-                try:
-                    precio_str = str(row[columnas['Precio']]).replace(",", ".").strip()
-                    precio = float(precio_str)
-                except:
-                    pass
-                
-                current_almacen = row[columnas['Almacén']] if pd.notnull(row[columnas['Almacén']]) else ''
-                current_fecha = row[columnas['Fecha']] if pd.notnull(row[columnas['Fecha']]) else ''
-                current_documento = row[columnas['Documento']] if pd.notnull(row[columnas['Documento']]) else ''
-                
-                # Extract reference and handle merged cells
-                current_ref = str(row[columnas['Referencia']]).strip().upper() if pd.notnull(row[columnas['Referencia']]) else ''
+def crear_parser():
+    parser = argparse.ArgumentParser(description="Procesa la exportación de movimientos de SILICE (entrada.xls o entrada.xlsx).")
+    parser.add_argument('--plantilla', help="Nombre de la plantilla de exportación: guarda su cabecera y omite la detección en las siguientes ejecuciones.")
+    parser.add_argument('--tabla-litros', default=ARCHIVO_LITROS, help=f"Fichero JSON con los litros por sufijo de referencia (amplía o sustituye la tabla por defecto; por defecto, {ARCHIVO_LITROS}).")
+    parser.add_argument('--formato', choices=FORMATOS_SALIDA, default='xlsx', help="Formato de la salida: xlsx con formato y resúmenes, o parquet/csv solo con las columnas, para cargas posteriores (por defecto, xlsx).")
+    parser.add_argument('--streaming', action='store_true', help="Lee el libro fila a fila sin cargar toda la hoja en memoria (exportaciones muy grandes).")
+    modo = parser.add_mutually_exclusive_group()
+    modo.add_argument('--lote', metavar='DIR_O_PATRON', help="Procesa todas las exportaciones de un directorio o patrón glob (p. ej. 'cierre/*.xls') en paralelo.")
+    modo.add_argument('--vigilar', metavar='DIR', help="Se queda en marcha vigilando un directorio y procesa cada exportación nueva o modificada en cuanto termina de copiarse (Ctrl+C para terminar).")
+    modo.add_argument('--buscar-lote', metavar='LOT', help="Consulta en el índice de trazabilidad qué clientes recibieron un LOT (p. ej. 24-118) y termina.")
+    modo.add_argument('--buscar-cliente', type=int, metavar='CLIENTE', help="Consulta en el índice de trazabilidad qué LOTs recibió un cliente y termina.")
+    parser.add_argument('--intervalo', type=float, default=INTERVALO_VIGILANCIA, help=f"Segundos entre revisiones del directorio vigilado (por defecto, {INTERVALO_VIGILANCIA}).")
+    parser.add_argument('--salida-dir', help="Directorio de las salidas de los modos lote y vigilancia (por defecto, el de cada entrada).")
+    parser.add_argument('--consolidado', metavar='FICHERO', help="En modo lote, escribe además una salida única con todos los ficheros.")
+    parser.add_argument('--procesos', type=int, help="Número de procesos de los modos lote y vigilancia (por defecto, uno por núcleo).")
+    parser.add_argument('--sin-cache', action='store_true', help="No usa ni actualiza la caché de hojas ya leídas.")
+    parser.add_argument('--limpiar-cache', action='store_true', help="Vacía la caché de hojas antes de procesar.")
+    parser.add_argument('--cache-dir', default=DIRECTORIO_CACHE, help=f"Directorio de la caché de hojas (por defecto, {DIRECTORIO_CACHE}).")
+    parser.add_argument('--cache-max-mb', type=int, default=MAX_MB_CACHE, help=f"Tamaño máximo de la caché en MB; se descartan primero las entradas menos usadas (por defecto, {MAX_MB_CACHE}).")
+    parser.add_argument('--trazabilidad', default=ARCHIVO_TRAZABILIDAD, metavar='FICHERO', help=f"Índice SQLite de LOTs al que se añaden los movimientos de cada ejecución y en el que buscan --buscar-lote y --buscar-cliente (por defecto, {ARCHIVO_TRAZABILIDAD}).")
+    parser.add_argument('--sin-trazabilidad', action='store_true', help="No actualiza el índice de trazabilidad de LOTs.")
+    parser.add_argument('--incremental', action='store_true', help="Procesa solo los movimientos nuevos desde la última ejecución (guarda un punto de control junto a cada salida) y los añade a la salida anterior.")
+    parser.add_argument('--paralelo', type=int, metavar='N', help="Divide la hoja en trozos independientes y los procesa en N procesos (hojas grandes, sin --streaming ni --incremental).")
+    parser.add_argument('--profile', action='store_true', help="Muestra el tiempo, las filas de entrada y salida y el pico de memoria de cada etapa.")
+    parser.add_argument('--cprofile', metavar='FICHERO', help="Guarda un volcado de cProfile de la ejecución (se lee con 'python -m pstats FICHERO'; no disponible en modo lote).")
+    return parser
 
-                # Initialize temporary row data
-                temp_fila = {
-                    'Almacén': current_almacen,
-                    'Fecha': current_fecha,
-                    'Referencia': current_ref,
-                    'Descripción': str(row[columnas['Descripción']]).strip().replace("nan", "").upper(),
-                    'Concepto': str(row[columnas['Concepto']]).strip().replace("nan", "").upper(),
-                    'Documento': current_documento,
-                    'Cliente / Prov.': cliente,
-                    'Cantidad': abs(cantidad),
-                    'Precio': abs(precio),
-                    'LOT': '',
-                }
-                
-                # Search subsequent rows for the LOT number
-                lot = None
-                lot_found = False
-                for next_index in range(index + 1, len(df)):
-                    next_row = df.iloc[next_index]
-                    
-                    # Check if current row is a header or empty
-                    current_row_str = ''
-                    for col in range(df.shape[1]):
-                        value = next_row[col]
-                        if pd.notnull(value):
-                            current_row_str = str(value).strip()
-                            break
-                    if header_pattern.search(current_row_str) or current_row_str == '':
-                        continue
-                    
-                    # Extract next reference and check if it's a new product
-                    next_ref = str(next_row[columnas['Referencia']]).strip().lower() if pd.notnull(next_row[columnas['Referencia']]) else ''
-                    if next_ref and next_ref.startswith('e') and next_ref != current_ref.lower() and not lot_found:
-                        break
-                    
-                    # Search for LOT pattern in all cells of the current row
-                    for col in range(df.shape[1]):
-                        lot_cell = str(next_row[col]).strip().upper()
-                        match = re.search(r'(\d{2}[-\s]\d{3})', lot_cell)
-                        if match:
-                            lot = re.sub(r'\s+', '', match.group(1))
-                            lot_found = True
-                            break
-                    if lot_found:
-                        break
-                
-                # Update the temporary row with the found LOT
-                temp_fila['LOT'] = lot if lot else ''
-                filas_combinadas.append(temp_fila)
-        
-        # Create the final DataFrame
-        df_final = pd.DataFrame(filas_combinadas)
-        
-        # Remove rows with missing concept and filter by specific conditions
-        df_final.dropna(subset=['Concepto'], inplace=True)
-        df_final['Concepto'] = df_final['Concepto'].str.strip()
-        df_final = df_final[df_final['Concepto'].isin(['SALIDA POR FACTURA', 'ENTRADA POR ABONO EN FACTURA'])]
-        df_final = df_final[df_final['Descripción'].str.contains('ABV', case=False, na=False)]
-        df_final = df_final[df_final['Referencia'].str.lower().str.startswith('e', na=False)]
-        
-        # Calculate LITRES and VALOR columns
-        df_final['LITRES'] = (df_final.apply(lambda row: get_litres_referencia(row['Referencia'], row['Concepto']), axis=1) * df_final['Cantidad']).abs()
-        df_final['VALOR'] = (df_final['Cantidad'] * df_final['Precio']).abs()
-        
-        # Export to Excel
-        df_final.to_excel(salida, index=False)
-        
-        # Add column filters and freeze header using openpyxl
-        wb = load_workbook(salida)
-        ws = wb.active
-        
-        # Freeze top row
-        ws.freeze_panes = 'A2'
-        
-        # Apply auto-filter to all columns
-        ws.auto_filter.ref = ws.dimensions
-        
-        # Save the modified workbook
-        wb.save(salida)
-        
-        print(f"Procesamiento completado. Salida guardada en: {salida}")
+def buscar_trazabilidad(args):
+    from silice_engine import IndiceTrazabilidad
     
-    except Exception as e:
-        print(f"Error durante el procesamiento: {e}")
+    if not os.path.exists(args.trazabilidad):
+        print(f"No existe el índice de trazabilidad: {args.trazabilidad}")
+        sys.exit(1)
+    indice = IndiceTrazabilidad(args.trazabilidad)
+    if args.buscar_lote:
+        resultado, buscado = indice.clientes_de_lote(args.buscar_lote), f"del LOT {args.buscar_lote}"
+    else:
+        resultado, buscado = indice.lotes_de_cliente(args.buscar_cliente), f"del cliente {args.buscar_cliente}"
+    if resultado.empty:
+        print(f"No hay movimientos {buscado} en el índice de trazabilidad.")
+        sys.exit(1)
+    print(f"Movimientos {buscado}:")
+    print(resultado.to_string(index=False))
 
-# Main execution block
-if __name__ == '__main__':
+def main():
+    args = crear_parser().parse_args()
+    if args.buscar_lote or args.buscar_cliente is not None:
+        buscar_trazabilidad(args)
+        sys.exit(0)
+    if args.vigilar and not os.path.isdir(args.vigilar):
+        print(f"No existe el directorio a vigilar: {args.vigilar}")
+        sys.exit(1)
+    
     # Define default filenames
     entrada_nombre = 'entrada'
     salida_nombre = 'salida'
     
-    # Determine file extension based on available files
-    if os.path.exists(f"{entrada_nombre}.xlsx"):
+    # Determine file extension based on available files (the output's comes from --formato)
+    salida = f"{salida_nombre}.{args.formato}"
+    if args.lote or args.vigilar:
+        entrada = None
+    elif os.path.exists(f"{entrada_nombre}.xlsx"):
         entrada = f"{entrada_nombre}.xlsx"
-        salida = f"{salida_nombre}.xlsx"
     elif os.path.exists(f"{entrada_nombre}.xls"):
         entrada = f"{entrada_nombre}.xls"
-        salida = f"{salida_nombre}.xls"
     else:
         print("No se encontró el archivo de entrada (entrada.xls o entrada.xlsx).")
         sys.exit(1)
     
+    from silice_engine import CacheHojas, Perfil, cargar_tabla_litros
+    from silice_proceso import procesar_lote, procesar_xls, vigilar
+    
+    cache = CacheHojas(args.cache_dir, args.cache_max_mb)
+    if args.limpiar_cache:
+        cache.limpiar()
+        print(f"Caché vaciada: {args.cache_dir}")
+    
+    opciones = {
+        'plantilla': args.plantilla,
+        'tabla_litros': cargar_tabla_litros(args.tabla_litros),
+        'streaming': args.streaming,
+        'cache': None if args.sin_cache else cache,
+        'incremental': args.incremental,
+        'paralelo': args.paralelo,
+        'trazabilidad': None if args.sin_trazabilidad else args.trazabilidad,
+    }
+    
+    if args.vigilar:
+        vigilar(args.vigilar, args.salida_dir, args.procesos, args.formato, args.intervalo, **opciones)
+        sys.exit(0)
+    
+    if args.lote:
+        estados = procesar_lote(args.lote, args.salida_dir, args.consolidado, args.procesos, args.profile, args.formato, **opciones)
+        sys.exit(0 if estados and all(estado['ok'] for estado in estados) else 1)
+    
     # Execute the processing function
-    procesar_xls(entrada, salida)
\ No newline at end of file
+    perfil = Perfil(memoria=args.profile)
+    if args.cprofile:
+        import cProfile
+        perfilador = cProfile.Profile()
+        perfilador.runcall(procesar_xls, entrada, salida, perfil=perfil, **opciones)
+        perfilador.dump_stats(args.cprofile)
+        print(f"Volcado de cProfile guardado en: {args.cprofile}")
+    else:
+        procesar_xls(entrada, salida, perfil=perfil, **opciones)
+    
+    if args.profile:
+        print(perfil.informe())
+
+# Main execution block
+if __name__ == '__main__':
+    main()
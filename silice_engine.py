@@ -0,0 +1,1622 @@
+import datetime
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import tracemalloc
+import warnings
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing, contextmanager
+from itertools import chain, islice
+
+import numpy as np
+import pandas as pd
+
+from silice_opciones import ARCHIVO_LITROS, ARCHIVO_TRAZABILIDAD, DIRECTORIO_CACHE, FORMATOS_SALIDA, MAX_MB_CACHE
+
+# Rows whose first non-empty cell starts like this are page or column headers
+HEADER_PATTERN = re.compile(r'^(?:movimientos:|almacén|página|fecha|referencia)', re.IGNORECASE)
+
+# LOT numbers look like 24-118 (sometimes written as 24 118)
+LOT_PATTERN = r'(\d{2}[-\s]\d{3})'
+
+
+def clasificar_filas(df, col_referencia):
+    """Classify every row of the raw sheet for the LOT search.
+
+    Returns three arrays aligned with the rows of ``df``:
+    - ``saltar``: header or empty rows, ignored by the search
+    - ``ref``: stripped lowercase reference, '' when the cell is empty
+    - ``lote``: first LOT match in column order, '' when there is none
+    """
+    valores = df.astype(object)
+    saltar = _filas_saltadas(valores)
+
+    referencias = valores.iloc[:, col_referencia]
+    ref = referencias.astype(str).str.strip().str.lower().where(referencias.notna(), '')
+
+    # First LOT match per row: earlier columns win, so only fill the gaps
+    lote = pd.Series(np.nan, index=valores.index, dtype=object)
+    for col in range(valores.shape[1]):
+        pendiente = lote.isna() & valores.iloc[:, col].notna()
+        if not pendiente.any():
+            continue
+        encontrados = valores.iloc[pendiente.to_numpy(), col].astype(str).str.extract(LOT_PATTERN, expand=False)
+        lote = lote.fillna(encontrados)
+    lote = lote.str.replace(r'\s+', '', regex=True).fillna('')
+
+    return saltar, ref.to_numpy(dtype=object), lote.to_numpy(dtype=object)
+
+
+def _filas_saltadas(valores):
+    """Header or empty rows (first non-empty cell blank or header-like)."""
+    notnull = valores.notna().to_numpy()
+    tiene_valor = notnull.any(axis=1)
+    primera = valores.to_numpy()[np.arange(len(valores)), notnull.argmax(axis=1)]
+    primera = pd.Series(primera, dtype=object).where(tiene_valor, '').astype(str).str.strip()
+    return ((primera == '') | primera.str.contains(HEADER_PATTERN)).to_numpy()
+
+
+class ResolutorLotes:
+    """Incremental LOT resolution over consecutive blocks of the raw sheet.
+
+    Applies the rules of the original forward scan: header and empty rows
+    are skipped, a row with a different ``E…`` reference ends the search,
+    and the first NN-NNN match found after the product row is its LOT.
+    Blocks must be fed in order and be indexed by their absolute row
+    position; products still open at the end of a block stay pending until
+    a later block (or ``cerrar``) settles them.
+
+    Pending products are grouped by normalised reference: a stop row closes
+    every group but its own, so each product is settled once even in long
+    runs of one reference without LOT lines.
+    """
+
+    def __init__(self, col_referencia):
+        self.col_referencia = col_referencia
+        self.pendientes = {}
+
+    def procesar(self, bloque, productos=None):
+        """Return ``{posición: LOT}`` for the products this block settles.
+
+        ``productos`` (a boolean mask over the block) limits the search to
+        the product rows that are actually wanted; by default every row
+        with a reference is one.
+        """
+        col_ref = self.col_referencia
+        saltar, ref, lote = clasificar_filas(bloque, col_ref)
+        producto = bloque.iloc[:, col_ref].notna().to_numpy() if productos is None else productos
+        parada = np.array([r.startswith('e') for r in ref], dtype=bool)
+        evento = ~saltar & (parada | (lote != ''))
+        posiciones = bloque.index
+
+        lotes = {}
+        pendientes = self.pendientes
+        for i in np.flatnonzero(evento | producto):
+            if evento[i]:
+                if parada[i]:
+                    # A new E… reference closes the search for every other
+                    # product; the ones with this reference get the row's LOT
+                    # or keep waiting
+                    mismas = pendientes.pop(ref[i], [])
+                    for grupo in pendientes.values():
+                        lotes.update(dict.fromkeys(grupo, ''))
+                    pendientes = {}
+                    if lote[i]:
+                        lotes.update(dict.fromkeys(mismas, lote[i]))
+                    elif mismas:
+                        pendientes[ref[i]] = mismas
+                else:
+                    for grupo in pendientes.values():
+                        lotes.update(dict.fromkeys(grupo, lote[i]))
+                    pendientes = {}
+            if producto[i]:
+                actual = str(bloque.iat[i, col_ref]).strip().upper().lower()
+                pendientes.setdefault(actual, []).append(int(posiciones[i]))
+        self.pendientes = pendientes
+        return lotes
+
+    def cerrar(self):
+        """Products still waiting at the end of the sheet have no LOT."""
+        lotes = {pos: '' for grupo in self.pendientes.values() for pos in grupo}
+        self.pendientes = {}
+        return lotes
+
+
+# Keywords that identify each required column in the header row
+# (all keywords of a column must appear in the same cell)
+COLUMNAS_CABECERA = {
+    'Almacén': ('almacén',),
+    'Fecha': ('fecha',),
+    'Referencia': ('referencia',),
+    'Descripción': ('descripción',),
+    'Concepto': ('concepto',),
+    'Documento': ('documento',),
+    'Cliente / Prov.': ('cliente', 'prov'),
+    'Cantidad': ('cantidad',),
+    'Precio': ('precio',),
+}
+
+# Only the top of the sheet is searched for the header
+MAX_FILAS_CABECERA = 200
+
+# Known header layouts, saved per export template
+ARCHIVO_PLANTILLAS = 'plantillas_cabecera.json'
+
+
+def _textos_cabecera(df):
+    valores = df.astype(object)
+    textos = valores.where(valores.notna(), '').to_numpy().astype(str)
+    return np.char.lower(np.char.strip(textos))
+
+
+def detectar_cabecera(df, max_filas=MAX_FILAS_CABECERA):
+    """Locate the header row and the column of each required field.
+
+    Works on the lowercased text of the first ``max_filas`` rows at once.
+    As in the original row-by-row scan, each column takes the first cell (in
+    reading order) containing its keywords, and the header row is the row
+    where the last of them was found. Returns ``(columnas, header_row)``.
+    """
+    textos = _textos_cabecera(df.iloc[:max_filas])
+    n_cols = textos.shape[1] if textos.ndim == 2 else 0
+
+    columnas = {}
+    header_row = -1
+    for nombre, claves in COLUMNAS_CABECERA.items():
+        encontrado = np.ones(textos.shape, dtype=bool)
+        for clave in claves:
+            encontrado &= np.char.find(textos, clave) >= 0
+        if not encontrado.any():
+            raise ValueError("No se pudieron identificar todas las columnas requeridas.")
+        fila, col = divmod(int(encontrado.argmax()), n_cols)
+        columnas[nombre] = col
+        header_row = max(header_row, fila)
+    return columnas, header_row
+
+
+def _cabecera_valida(df, columnas, header_row):
+    if header_row >= len(df) or set(columnas) != set(COLUMNAS_CABECERA):
+        return False
+    if any(col >= df.shape[1] for col in columnas.values()):
+        return False
+    textos = _textos_cabecera(df.iloc[header_row:header_row + 1])[0]
+    return all(
+        all(clave in textos[columnas[nombre]] for clave in claves)
+        for nombre, claves in COLUMNAS_CABECERA.items()
+    )
+
+
+def escribir_atomico(ruta, escribir):
+    """Write ``ruta`` through ``escribir(temporal)`` and rename it into place.
+
+    Readers never see a half-written file. The temporary name carries the
+    process and thread, so concurrent writers of the same file (CLI
+    processes, app sessions) do not share it; the last rename wins.
+    """
+    temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        escribir(temporal)
+        os.replace(temporal, ruta)
+    finally:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+
+
+def escribir_json(ruta, datos, **opciones):
+    """Write ``datos`` as UTF-8 JSON through escribir_atomico."""
+    def escribir(temporal):
+        with open(temporal, 'w', encoding='utf-8') as f:
+            json.dump(datos, f, ensure_ascii=False, **opciones)
+    escribir_atomico(ruta, escribir)
+
+
+def cargar_plantillas(ruta=ARCHIVO_PLANTILLAS):
+    if not os.path.exists(ruta):
+        return {}
+    with open(ruta, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def guardar_plantilla(nombre, columnas, header_row, ruta=ARCHIVO_PLANTILLAS):
+    plantillas = cargar_plantillas(ruta)
+    plantillas[nombre] = {'columnas': columnas, 'header_row': header_row}
+    escribir_json(ruta, plantillas, indent=2)
+
+
+def localizar_cabecera(df, plantilla=None, ruta_plantillas=ARCHIVO_PLANTILLAS):
+    """Return ``(columnas, header_row)`` for the sheet.
+
+    When ``plantilla`` names a saved export template whose header row still
+    matches the sheet, its layout is used directly and detection is skipped.
+    Otherwise the header is detected and, if a template name was given,
+    saved for the next run.
+    """
+    if plantilla:
+        guardada = cargar_plantillas(ruta_plantillas).get(plantilla)
+        if guardada and _cabecera_valida(df, guardada['columnas'], guardada['header_row']):
+            return dict(guardada['columnas']), guardada['header_row']
+
+    columnas, header_row = detectar_cabecera(df)
+    if plantilla:
+        guardar_plantilla(plantilla, columnas, header_row, ruta_plantillas)
+    return columnas, header_row
+
+
+# Litres per unit, keyed by the numeric suffix of the reference
+LITROS_POR_SUFIJO = {
+    '10': 10.0,
+    '20': 20.0,
+    '30': 30.0,
+    '44': 0.44,
+    '33': 0.33,
+    '37': 0.37,
+}
+
+# The suffix is the trailing number, optionally followed by C or I (20I, 33C…)
+SUFIJO_PATTERN = r'(\d+)[CI]?$'
+
+
+def cargar_tabla_litros(ruta=ARCHIVO_LITROS):
+    """Build the suffix → litres table, applying the JSON config if present."""
+    tabla = dict(LITROS_POR_SUFIJO)
+    if ruta and os.path.exists(ruta):
+        with open(ruta, encoding='utf-8') as f:
+            tabla.update({str(sufijo): float(litros) for sufijo, litros in json.load(f).items()})
+    return tabla
+
+
+def calcular_litros(referencias, tabla=None):
+    """Litres per unit for a whole column of references.
+
+    The suffix of every reference is extracted in one step (spaces are
+    ignored) and mapped through ``tabla``; unknown suffixes and non-text
+    references count as 0.
+    """
+    if tabla is None:
+        tabla = cargar_tabla_litros()
+    if isinstance(referencias.dtype, pd.CategoricalDtype):
+        # Once per distinct reference, then spread through the codes
+        litros = calcular_litros(pd.Series(referencias.cat.categories, dtype=object), tabla).to_numpy()
+        codigos = referencias.cat.codes.to_numpy()
+        return pd.Series(np.where(codigos >= 0, litros[codigos], 0.0), index=referencias.index)
+    es_texto = np.array([isinstance(ref, str) for ref in referencias], dtype=bool)
+    sufijos = (
+        referencias.where(es_texto, '').astype(str)
+        .str.upper().str.replace(' ', '', regex=False).str.strip()
+        .str.extract(SUFIJO_PATTERN, expand=False)
+    )
+    return sufijos.map(tabla).fillna(0.0).where(es_texto, 0.0).astype(float)
+
+
+# Strings pd.read_excel turns into NaN by default; the streaming reader
+# does the same so both ingestion modes see identical rows
+VALORES_NULOS = {
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+    '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a',
+    'nan', 'null',
+}
+
+# Rows handed to the LOT engine at a time
+TAMANO_BLOQUE = 50_000
+
+
+def _valor_celda(valor):
+    if isinstance(valor, str):
+        return np.nan if valor in VALORES_NULOS else valor
+    if valor is None:
+        return np.nan
+    if isinstance(valor, float) and valor.is_integer():
+        return int(valor)
+    return valor
+
+
+def _filas_xlsx(origen):
+    from openpyxl import load_workbook
+
+    wb = load_workbook(origen, read_only=True, data_only=True)
+    try:
+        for fila in wb.worksheets[0].iter_rows(values_only=True):
+            yield tuple(_valor_celda(valor) for valor in fila)
+    finally:
+        wb.close()
+
+
+def _filas_xls(origen):
+    import xlrd
+
+    if isinstance(origen, (str, os.PathLike)):
+        libro = xlrd.open_workbook(origen, on_demand=True)
+    else:
+        libro = xlrd.open_workbook(file_contents=origen.read(), on_demand=True)
+    try:
+        hoja = libro.sheet_by_index(0)
+        for r in range(hoja.nrows):
+            fila = [np.nan] * hoja.ncols
+            for c, celda in enumerate(hoja.row(r)):
+                if celda.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK, xlrd.XL_CELL_ERROR):
+                    continue
+                if celda.ctype == xlrd.XL_CELL_DATE:
+                    fila[c] = xlrd.xldate_as_datetime(celda.value, libro.datemode)
+                elif celda.ctype == xlrd.XL_CELL_BOOLEAN:
+                    fila[c] = bool(celda.value)
+                else:
+                    fila[c] = _valor_celda(celda.value)
+            yield tuple(fila)
+    finally:
+        libro.release_resources()
+
+
+def iterar_filas(origen, extension=None):
+    """Stream the rows of the first sheet of an .xls/.xlsx export.
+
+    ``origen`` is a path or a binary file object (pass ``extension`` when it
+    has no name). Rows are tuples of cell values with NaN for empty cells;
+    trailing empty rows are dropped, as pd.read_excel does. xlsx files are
+    read with openpyxl in read-only mode and xls files with xlrd on demand,
+    so the whole sheet is never materialised as a DataFrame.
+    """
+    if extension is None:
+        extension = os.path.splitext(str(getattr(origen, 'name', origen)))[1]
+    lector = _filas_xls if extension.lower() == '.xls' else _filas_xlsx
+
+    vacias = []
+    for fila in lector(origen):
+        if all(pd.isna(valor) for valor in fila):
+            vacias.append(fila)
+            continue
+        yield from vacias
+        vacias = []
+        yield fila
+
+
+def _bloques(origen, tamano, inicio=0):
+    # Blocks indexed by sheet position, the first row of origen being at inicio
+    if isinstance(origen, pd.DataFrame):
+        origen = origen.set_axis(range(inicio, inicio + len(origen)))
+        for desde in range(0, len(origen), tamano):
+            yield origen.iloc[desde:desde + tamano]
+        return
+
+    filas = iter(origen)
+    ancho = 0
+    while True:
+        registros = list(islice(filas, tamano))
+        if not registros:
+            return
+        bloque = pd.DataFrame(registros, index=range(inicio, inicio + len(registros)))
+        ancho = max(ancho, bloque.shape[1])
+        if bloque.shape[1] < ancho:
+            bloque = bloque.reindex(columns=range(ancho))
+        yield bloque
+        inicio += len(registros)
+
+
+def _combinar(origen, construir, plantilla, cierre_por_fila_vacia, tamano_bloque, cabecera, filtro, progreso=None, inicio=0, registrar_filas=None):
+    # Core of combinar_tabla (through _productos): yields the header
+    # (columnas, header_row) first, then (posición, construir(...), LOT) of
+    # every product row kept, in sheet order
+    bloques = _bloques(origen, max(tamano_bloque, MAX_FILAS_CABECERA), inicio)
+    primero = next(bloques, None)
+    if primero is None:
+        if cabecera is None:
+            raise ValueError("No se pudieron identificar todas las columnas requeridas.")
+        # Resuming at the end of the sheet: nothing new to combine
+        yield cabecera
+        return
+    columnas, header_row = cabecera or localizar_cabecera(primero, plantilla)
+    yield columnas, header_row
+    col_ref = columnas['Referencia']
+
+    resolutor = ResolutorLotes(col_ref)
+    lotes = {}
+    en_espera = deque()
+    anterior = None
+    completados = con_lote = 0
+    for bloque in chain([primero], bloques):
+        con_ref = bloque.iloc[:, col_ref].notna().to_numpy()
+        valores = bloque.to_numpy(dtype=object)
+        posiciones = bloque.index
+        if registrar_filas is not None:
+            registrar_filas(valores, columnas)
+        productos = np.flatnonzero(con_ref)
+        if filtro is not None and len(productos):
+            productos = productos[filtro(valores[productos], columnas, posiciones[productos])]
+
+        if cierre_por_fila_vacia:
+            # The last product of the previous block depends on this block's first row
+            if anterior is not None and not con_ref[0]:
+                en_espera.append(anterior)
+            anterior = None
+            if len(productos) and productos[-1] == len(bloque) - 1:
+                ultimo = productos[-1]
+                anterior = (int(posiciones[ultimo]), construir(valores[ultimo], columnas))
+                productos = productos[:-1]
+            productos = productos[~con_ref[productos + 1]]
+
+        for i in productos:
+            en_espera.append((int(posiciones[i]), construir(valores[i], columnas)))
+
+        buscados = None
+        if filtro is not None:
+            buscados = np.zeros(len(bloque), dtype=bool)
+            buscados[productos] = True
+            if anterior is not None:
+                buscados[-1] = True
+        lotes.update(resolutor.procesar(bloque, buscados))
+        while en_espera and en_espera[0][0] in lotes:
+            pos, registro = en_espera.popleft()
+            lote = lotes.pop(pos)
+            completados += 1
+            con_lote += lote != ''
+            yield pos, registro, lote
+
+        # Forget LOTs of products that were not kept
+        abiertos = [registro[0] for registro in (en_espera[0] if en_espera else None, anterior) if registro]
+        limite = min(abiertos, default=posiciones[-1] + 1)
+        lotes = {pos: lote for pos, lote in lotes.items() if pos >= limite}
+        if progreso is not None:
+            progreso(int(posiciones[-1]) + 1, completados, con_lote)
+
+    lotes.update(resolutor.cerrar())
+    for pos, registro in en_espera:
+        yield pos, registro, lotes.get(pos, '')
+
+
+def _fila_cruda(fila, columnas):
+    return fila
+
+
+def _apilar(filas, ancho):
+    # Raw rows (1-D object arrays, possibly of different widths) as one 2-D array
+    if filas and all(len(fila) == ancho for fila in filas):
+        return np.stack(filas)
+    tabla = np.full((len(filas), ancho), np.nan, dtype=object)
+    for i, fila in enumerate(filas):
+        tabla[i, :len(fila)] = fila
+    return tabla
+
+
+def _productos(origen, plantilla=None, cierre_por_fila_vacia=False, tamano_bloque=TAMANO_BLOQUE, cabecera=None, filtro=None, progreso=None, inicio=0, registrar_filas=None):
+    # Raw cells of the product rows kept, as arrays: (cabecera, posiciones, valores, lotes).
+    # Rows are stacked every tamano_bloque so the blocks they come from are released
+    partes = _combinar(origen, _fila_cruda, plantilla, cierre_por_fila_vacia, tamano_bloque, cabecera, filtro, progreso, inicio, registrar_filas)
+    cabecera = next(partes)
+    posiciones, lotes, trozos, filas = [], [], [], []
+    for pos, fila, lote in partes:
+        posiciones.append(pos)
+        lotes.append(lote)
+        filas.append(fila)
+        if len(filas) == tamano_bloque:
+            trozos.append(_apilar(filas, max(len(fila) for fila in filas)))
+            filas = []
+    trozos.append(_apilar(filas, max((len(fila) for fila in filas), default=max(cabecera[0].values()) + 1)))
+    return cabecera, np.array(posiciones, dtype=np.int64), _concatenar_trozos(trozos), lotes
+
+
+def _concatenar_trozos(trozos):
+    ancho = max(trozo.shape[1] for trozo in trozos)
+    return np.concatenate([trozo if trozo.shape[1] == ancho else _apilar(list(trozo), ancho) for trozo in trozos])
+
+
+def _tabla_final(construir, valores, columnas, posiciones, lotes, columna_fila):
+    df = construir(valores, columnas)
+    df['LOT'] = pd.Categorical(lotes)
+    if columna_fila:
+        df[columna_fila] = posiciones
+    return df
+
+
+def combinar_tabla(origen, construir, plantilla=None, cierre_por_fila_vacia=False, tamano_bloque=TAMANO_BLOQUE, cabecera=None, filtro=None, columna_fila=None, progreso=None, inicio=0, registrar_filas=None):
+    """Combine every product row with its LOT into one typed DataFrame.
+
+    ``origen`` is the raw sheet, either as a DataFrame or as an iterable of
+    row tuples (see ``iterar_filas``). It is consumed in blocks, so with a
+    streaming source only the current block and the rows still waiting for
+    their LOT are held in memory. No per-row record is built: the raw cells
+    of the product rows kept are collected as a 2-D object array and
+    ``construir(valores, columnas)`` turns them, column-wise, into the
+    output frame (categoricals for repeated text, real dtypes for dates and
+    numbers). The 'LOT' column is added here as a categorical, and the
+    sheet position (0-based) under ``columna_fila`` as int64.
+
+    With ``cierre_por_fila_vacia`` a product is only kept when the row right
+    after it has no reference, which is how the Streamlit app has always
+    closed its records. A known ``cabecera`` (``(columnas, header_row)``)
+    skips header detection.
+
+    ``filtro(valores, columnas, posiciones)`` (e.g. a ``FiltroReglas``)
+    receives the cells and sheet positions of the product rows of each
+    block and returns a boolean mask of the ones to keep; the others are
+    neither built nor searched for a LOT.
+
+    ``progreso(filas, registros, lotes)`` is called after each block with
+    the sheet rows read so far, the records completed and how many of them
+    got a LOT. It may raise to stop the run (e.g. when it is cancelled).
+
+    ``inicio`` is the sheet position of the first row of ``origen``, to
+    resume part-way through a sheet (see ``PuntoControl``; the header must
+    then be given). ``registrar_filas(valores, columnas)`` receives the raw
+    cells of every block read.
+    """
+    (columnas, _), posiciones, valores, lotes = _productos(origen, plantilla, cierre_por_fila_vacia, tamano_bloque, cabecera, filtro, progreso,
+                                                           inicio, registrar_filas)
+    return _tabla_final(construir, valores, columnas, posiciones, lotes, columna_fila)
+
+
+# ------------------------------------------------------------------------ #
+# Parallel combining: independent chunks of the sheet on a process pool
+
+# Sheets with fewer data rows per process than this are combined in-process
+FILAS_MINIMAS_TROZO = 20_000
+
+
+def cortes_seguros(df, col_referencia, partes):
+    """Row positions where the sheet can be cut into about ``partes`` chunks.
+
+    A cut goes right before an E… reference row that closes every pending
+    LOT search: it is not a header/empty row, and no E… row since the
+    previous such stop has the same reference (products with that reference
+    would stay open through it). Searches then never cross a cut, and a
+    product right before it is not closed by an empty row either.
+    """
+    referencias = df.iloc[:, col_referencia]
+    ref = referencias.map(str, na_action='ignore').str.strip().str.lower()
+    filas_e = np.flatnonzero(ref.str.startswith('e', na=False).to_numpy())
+    if len(filas_e) == 0:
+        return []
+    saltar = _filas_saltadas(df.iloc[filas_e].astype(object))
+    ref = ref.to_numpy()
+
+    tamano = -(-len(df) // partes)
+    cortes = []
+    siguiente = tamano
+    abiertas = set()
+    for fila, saltada in zip(filas_e, saltar):
+        if not saltada:
+            if fila >= siguiente and ref[fila] not in abiertas:
+                cortes.append(int(fila))
+                siguiente = fila + tamano
+            abiertas = set()
+        abiertas.add(ref[fila])
+    return cortes
+
+
+class _FiltroSeleccion:
+    """Filter of a chunk: product rows already selected in the parent process."""
+
+    def __init__(self, seleccion):
+        self.seleccion = seleccion
+
+    def __call__(self, valores, columnas, posiciones):
+        return self.seleccion[posiciones]
+
+
+def _combinar_trozo(trozo, inicio, cabecera, filtro, cierre_por_fila_vacia):
+    _, posiciones, valores, lotes = _productos(trozo, cierre_por_fila_vacia=cierre_por_fila_vacia, cabecera=cabecera, filtro=filtro)
+    return posiciones + inicio, valores, lotes
+
+
+def combinar_en_paralelo(df, construir, cabecera, procesos, filtro=None, cierre_por_fila_vacia=False, columna_fila=None):
+    """``combinar_tabla`` over a whole in-memory sheet, chunked on ``procesos`` processes.
+
+    The sheet is cut at ``cortes_seguros`` so the rows, in sheet order,
+    are exactly the ones of a single-process run. ``filtro`` (a stateless
+    one such as ``FiltroReglas``) runs once over all product rows in this
+    process and the chunks get the selection; the chunks return the raw
+    cells of their rows and ``construir`` builds the typed frame here, once.
+    Small sheets are combined in-process.
+    """
+    columnas, _ = cabecera
+    procesos = min(procesos, max(1, len(df) // FILAS_MINIMAS_TROZO))
+    limites = [0] + cortes_seguros(df, columnas['Referencia'], procesos) + [len(df)]
+    if len(limites) <= 2:
+        return combinar_tabla(df, construir, cierre_por_fila_vacia=cierre_por_fila_vacia, cabecera=cabecera,
+                              filtro=filtro, columna_fila=columna_fila)
+
+    seleccion = None
+    if filtro is not None:
+        productos = np.flatnonzero(df.iloc[:, columnas['Referencia']].notna().to_numpy())
+        seleccion = np.zeros(len(df), dtype=bool)
+        seleccion[productos[filtro(df.iloc[productos].to_numpy(dtype=object), columnas, productos)]] = True
+
+    with ProcessPoolExecutor(max_workers=len(limites) - 1) as pool:
+        futuros = [
+            pool.submit(_combinar_trozo, df.iloc[inicio:fin], inicio, cabecera,
+                        None if seleccion is None else _FiltroSeleccion(seleccion[inicio:fin]), cierre_por_fila_vacia)
+            for inicio, fin in zip(limites, limites[1:])
+        ]
+        partes = [futuro.result() for futuro in futuros]
+    posiciones = np.concatenate([parte[0] for parte in partes])
+    valores = _concatenar_trozos([parte[1] for parte in partes])
+    lotes = [lote for parte in partes for lote in parte[2]]
+    return _tabla_final(construir, valores, columnas, posiciones, lotes, columna_fila)
+
+
+class Regla:
+    """One rule of the rule set that decides which output rows are kept.
+
+    ``condicion`` takes the Series of the output field ``campo`` and returns
+    a boolean mask. A filter rule keeps the rows where it holds; a rule with
+    ``asignar`` ({field: value}) sets those fields where it holds instead.
+    """
+
+    def __init__(self, nombre, campo, condicion, asignar=None):
+        self.nombre = nombre
+        self.campo = campo
+        self.condicion = condicion
+        self.asignar = asignar
+
+
+def aplicar_reglas(df, reglas):
+    """Apply a rule set, in order, to the built output frame."""
+    for regla in reglas:
+        cumple = regla.condicion(df[regla.campo])
+        if regla.asignar is None:
+            df = df[cumple]
+        else:
+            for campo, valor in regla.asignar.items():
+                df.loc[cumple, campo] = valor
+    return df
+
+
+class FiltroReglas:
+    """Early evaluation of the filter rules on the raw product rows.
+
+    ``campos`` maps each field used by the rules to a function
+    ``(valores, columnas) -> Series`` deriving it, vectorized, from the raw
+    cells the same way the entry point's record builder does. Used as the
+    ``filtro`` of ``combinar_tabla`` so discarded rows are never built nor
+    searched for a LOT; the rule set must still be applied to the output
+    (``aplicar_reglas``) for its assignment rules. Rows in/out and time of
+    each rule are accumulated over all blocks (see ``registrar``).
+    """
+
+    def __init__(self, reglas, campos):
+        self.reglas = [regla for regla in reglas if regla.asignar is None]
+        self.campos = campos
+        self.conteos = {regla.nombre: [0, 0, 0.0] for regla in self.reglas}
+
+    def __call__(self, valores, columnas, posiciones=None):
+        mantener = np.ones(len(valores), dtype=bool)
+        derivados = {}
+        for regla in self.reglas:
+            inicio = time.perf_counter()
+            filas = np.flatnonzero(mantener)
+            if regla.campo not in derivados:
+                derivados[regla.campo] = self.campos[regla.campo](valores, columnas)
+            cumple = np.asarray(regla.condicion(derivados[regla.campo].iloc[filas]), dtype=bool)
+            mantener[filas[~cumple]] = False
+            conteo = self.conteos[regla.nombre]
+            conteo[0] += len(filas)
+            conteo[1] += int(cumple.sum())
+            conteo[2] += time.perf_counter() - inicio
+        return mantener
+
+    def registrar(self, perfil):
+        """Add one sub-stage per rule (totals over all blocks) to ``perfil``."""
+        for nombre, (entrada, salida, segundos) in self.conteos.items():
+            perfil.subetapa(nombre, segundos, entrada, salida)
+
+
+def texto_celdas(valores, columna):
+    """Cells of one column as stripped text, like ``str(celda).strip()``."""
+    return pd.Series(valores[:, columna], dtype=object).map(str).str.strip()
+
+
+# Numeric output columns: integer ones (int32) read empty cells as 0,
+# amounts keep them as NaN and are made absolute
+COLUMNAS_ENTERAS = ['Cliente / Prov.']
+COLUMNAS_IMPORTE = ['Cantidad', 'Precio']
+
+# Date output columns (datetime64, empty cells as NaT)
+COLUMNAS_FECHA = ['Fecha']
+
+# Excel serial dates count days from this one
+ORIGEN_SERIE_EXCEL = '1899-12-30'
+
+# Text dates written year first (2025-01-03, optionally with a time)
+ISO_PATTERN = r'^\d{4}-\d{2}-\d{2}'
+
+# Spanish-formatted numbers with thousands separators, e.g. 1.234,56
+MILES_PATTERN = r'^[+-]?\d{1,3}(?:\.\d{3})+(?:,\d*)?$'
+
+
+def convertir_numeros(valores, entero=False):
+    """Parse a column of raw cells as numbers, vectorized and locale aware.
+
+    Numeric cells are kept as they are. Text accepts a decimal comma and,
+    together with it, dots as thousands separators ('1.234,5'); a text with
+    only dots keeps them as decimal points, like ``float()``. Empty cells
+    stay NaN (0 with ``entero``, which also truncates to int32; values out
+    of its range are invalid).
+
+    Returns ``(numeros, invalidos)``: the parsed Series, with 0 in the
+    non-empty cells that could not be parsed, and the mask of those cells.
+    """
+    serie = pd.Series(valores, dtype=object)
+    vacias = serie.isna()
+    # Numbers and plain numeric text in one go; only the rest is looked at as text
+    numeros = pd.to_numeric(serie, errors='coerce').astype(float)
+
+    texto = serie[numeros.isna() & ~vacias].map(str).str.strip()
+    vacias[texto.index[texto.str.lower() == 'nan']] = True
+    miles = texto.str.match(MILES_PATTERN)
+    texto = texto.where(~miles, texto.str.replace('.', '', regex=False)).str.replace(',', '.', regex=False)
+    numeros.update(pd.to_numeric(texto, errors='coerce'))
+
+    invalidos = numeros.isna() & ~vacias
+    if entero:
+        invalidos |= numeros.abs() > np.iinfo(np.int32).max
+        numeros = numeros.where(~invalidos & numeros.notna(), 0).astype(np.int32)
+    else:
+        numeros = numeros.mask(invalidos, 0.0)
+    return numeros, invalidos
+
+
+def convertir_fechas(valores):
+    """Parse a column of raw cells as dates, vectorized.
+
+    Date cells are kept as they are and numbers are Excel serial dates. Text
+    written year first (ISO, '2025-01-03' or '2025-01-03 00:00:00') is read
+    as such, any other text day first ('03/01/2025').
+
+    Returns ``(fechas, invalidos)``: the parsed datetime64 Series, with NaT
+    in the empty cells and in the ones that could not be parsed, and the
+    mask of the latter.
+    """
+    serie = pd.Series(valores, dtype=object)
+    vacias = serie.isna()
+    es_fecha = serie.map(lambda valor: isinstance(valor, (datetime.date, np.datetime64)))
+    fechas = pd.to_datetime(serie.where(es_fecha), errors='coerce')
+
+    numeros = pd.to_numeric(serie.where(~es_fecha & ~vacias), errors='coerce')
+    serial = numeros.notna()
+    fechas[serial] = pd.to_datetime(numeros[serial], unit='D', origin=ORIGEN_SERIE_EXCEL, errors='coerce')
+
+    texto = serie[~es_fecha & ~serial & ~vacias].map(str).str.strip()
+    vacias[texto.index[texto.str.lower().isin(['', 'nan', 'nat'])]] = True
+    iso = texto.str.match(ISO_PATTERN)
+    fechas.update(pd.to_datetime(texto[iso], errors='coerce', format='ISO8601'))
+    fechas.update(pd.to_datetime(texto[~iso], errors='coerce', dayfirst=True, format='mixed'))
+
+    invalidos = fechas.isna() & ~vacias
+    return fechas, invalidos
+
+
+def convertir_columnas(df, columna_fila=None):
+    """Convert the numeric and date output columns of ``df`` in place, column-wise.
+
+    Returns the report of unparseable cells (numbers set to 0, dates to
+    NaT) as a DataFrame with 'Fila' (the 1-based sheet row, taken from
+    ``columna_fila``), 'Columna' and 'Valor'.
+    """
+    errores = []
+    for columna in COLUMNAS_ENTERAS + COLUMNAS_IMPORTE + COLUMNAS_FECHA:
+        crudas = df[columna].to_numpy(dtype=object)
+        if columna in COLUMNAS_FECHA:
+            convertidas, invalidos = convertir_fechas(crudas)
+        else:
+            convertidas, invalidos = convertir_numeros(crudas, entero=columna in COLUMNAS_ENTERAS)
+        invalidos = invalidos.to_numpy()
+        if invalidos.any():
+            errores.append(pd.DataFrame({
+                'Fila': df[columna_fila].to_numpy()[invalidos] + 1 if columna_fila else np.flatnonzero(invalidos) + 1,
+                'Columna': columna,
+                'Valor': crudas[invalidos].astype(str),
+            }))
+        if columna in COLUMNAS_IMPORTE:
+            df[columna] = np.abs(convertidas.to_numpy())
+        else:
+            df[columna] = convertidas.to_numpy()
+    if not errores:
+        return pd.DataFrame(columns=['Fila', 'Columna', 'Valor'])
+    return pd.concat(errores, ignore_index=True).sort_values(['Fila', 'Columna'], ignore_index=True)
+
+
+def resumen_errores(errores, max_filas=20):
+    """Plain-text summary of the unparseable cells report."""
+    if errores.empty:
+        return "Sin valores no válidos."
+    lineas = [f"Valores no válidos (los números se toman como 0 y las fechas quedan vacías): {len(errores)}"]
+    for fila, columna, valor in errores.head(max_filas).itertuples(index=False):
+        lineas.append(f"  fila {fila:>7}  {columna:16} {valor!r}")
+    if len(errores) > max_filas:
+        lineas.append(f"  ... y {len(errores) - max_filas} más")
+    return '\n'.join(lineas)
+
+
+# Month of each movement in the summaries (first day of the month)
+COLUMNA_MES = 'Mes'
+
+# Dimensions of the base aggregate, from which every summary is derived
+DIMENSIONES_AGREGADO = ['Referencia', 'LOT', 'Cliente / Prov.', 'Concepto', COLUMNA_MES]
+
+# Summary sheets of the export and their dimensions
+RESUMENES = {
+    'Por referencia': ['Referencia'],
+    'Por LOT': ['LOT'],
+    'Por cliente': ['Cliente / Prov.'],
+    'Por concepto': ['Concepto'],
+    'Por mes': [COLUMNA_MES],
+}
+
+
+def _sumar(df, dimensiones, medidas):
+    return df.groupby(dimensiones, observed=True, dropna=False).agg(**medidas).reset_index()
+
+
+def calcular_agregados(df):
+    """KPIs and summary tables of the processed frame.
+
+    A single groupby pass over ``df`` builds the base aggregate (Registros,
+    LITRES and VALOR per combination of DIMENSIONES_AGREGADO); the KPIs and
+    every summary in RESUMENES are then taken from that much smaller table.
+    Returns ``(indicadores, resumenes)``: a dict of KPIs and a dict
+    {sheet name: DataFrame}.
+    """
+    mes = pd.to_datetime(df['Fecha'], errors='coerce').dt.to_period('M').dt.to_timestamp()
+    base = _sumar(df.assign(**{COLUMNA_MES: mes}), DIMENSIONES_AGREGADO,
+                  {'Registros': ('LITRES', 'size'), 'LITRES': ('LITRES', 'sum'), 'VALOR': ('VALOR', 'sum')})
+
+    sumas = {medida: (medida, 'sum') for medida in ('Registros', 'LITRES', 'VALOR')}
+    resumenes = {hoja: _sumar(base, dimensiones, sumas) for hoja, dimensiones in RESUMENES.items()}
+
+    por_concepto = Counter()
+    for concepto, registros in resumenes['Por concepto'][['Concepto', 'Registros']].itertuples(index=False):
+        por_concepto[str(concepto).strip().lower()] += int(registros)
+    indicadores = {
+        'registros': int(base['Registros'].sum()),
+        'sin_lote': int(base.loc[base['LOT'] == '', 'Registros'].sum()),
+        'referencias': int(base['Referencia'].nunique()),
+        'litros': float(base['LITRES'].sum()),
+        'valor': float(base['VALOR'].sum()),
+        'por_concepto': dict(por_concepto),
+    }
+    return indicadores, resumenes
+
+
+# Number formats of the output columns in the xlsx export
+FORMATOS_COLUMNA = {
+    'Fecha': 'DD/MM/YYYY',
+    COLUMNA_MES: 'MM/YYYY',
+    'Cantidad': '#,##0.00',
+    'Precio': '#,##0.00',
+    'LITRES': '#,##0.00',
+    'VALOR': '#,##0.00',
+}
+
+# Rows sampled to size each column, and the widest a column may get
+FILAS_ANCHO_COLUMNA = 1000
+MAX_ANCHO_COLUMNA = 50
+
+
+def _ancho_columna(nombre, serie):
+    muestra = serie.head(FILAS_ANCHO_COLUMNA).dropna().astype(str).str.len()
+    ancho = max(len(str(nombre)), int(muestra.max()) if len(muestra) else 0)
+    return min(ancho + 2, MAX_ANCHO_COLUMNA)
+
+
+def _celdas_formateadas(ws, valores, formato):
+    from openpyxl.cell import WriteOnlyCell
+
+    for valor in valores:
+        if valor is None or isinstance(valor, str):
+            yield valor
+            continue
+        celda = WriteOnlyCell(ws, value=valor)
+        celda.number_format = formato
+        yield celda
+
+
+def escribir_excel(df, destino, hoja='Resultado', hojas_extra=None):
+    """Write the processed frame as a formatted xlsx in a single pass.
+
+    Uses a write-only openpyxl workbook: the frozen header, autofilter,
+    column widths and number formats are declared before the rows are
+    streamed out, so the file is never reloaded and saved a second time.
+    ``hojas_extra`` ({sheet name: DataFrame}, e.g. the summaries of
+    ``calcular_agregados``) are written after the main sheet, formatted
+    the same way. ``destino`` is a path or a binary file object.
+    """
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    for nombre, tabla in {hoja: df, **(hojas_extra or {})}.items():
+        _escribir_hoja(wb, tabla, nombre)
+    wb.save(destino)
+
+
+def _escribir_hoja(wb, df, hoja):
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+    from openpyxl.utils import get_column_letter
+
+    ws = wb.create_sheet(hoja)
+    nombres = list(df.columns)
+
+    ws.freeze_panes = 'A2'
+    if nombres:
+        ws.auto_filter.ref = f"A1:{get_column_letter(len(nombres))}{len(df) + 1}"
+    for col, nombre in enumerate(nombres, start=1):
+        ws.column_dimensions[get_column_letter(col)].width = _ancho_columna(nombre, df[nombre])
+
+    negrita = Font(bold=True)
+    cabecera = []
+    for nombre in nombres:
+        celda = WriteOnlyCell(ws, value=str(nombre))
+        celda.font = negrita
+        cabecera.append(celda)
+    ws.append(cabecera)
+
+    # Columns as plain lists with None for missing values; formatted
+    # columns yield a styled cell per value as the rows are written
+    columnas = []
+    for nombre in nombres:
+        serie = df[nombre].astype(object)
+        valores = serie.where(serie.notna(), None).tolist()
+        formato = FORMATOS_COLUMNA.get(nombre)
+        if formato:
+            valores = _celdas_formateadas(ws, valores, formato)
+        columnas.append(valores)
+    for fila in zip(*columnas):
+        ws.append(fila)
+
+
+# ------------------------------------------------------------------------ #
+# Machine-readable exports: the processed columns without a workbook
+
+# Rows converted to text at a time in the CSV export
+FILAS_TROZO_CSV = 100_000
+
+
+def _mixta(valores):
+    return pd.api.types.infer_dtype(valores, skipna=True).startswith('mixed')
+
+
+def _columnas_parquet(df):
+    # Parquet needs one type per column: text columns that also hold
+    # numbers (an Almacén with '01' and 1) are written as text
+    columnas = {}
+    for nombre in df.columns:
+        serie = df[nombre]
+        if isinstance(serie.dtype, pd.CategoricalDtype) and _mixta(serie.cat.categories):
+            serie = serie.astype(object).map(str, na_action='ignore').astype('category')
+        elif serie.dtype == object and _mixta(serie):
+            serie = serie.map(str, na_action='ignore')
+        columnas[nombre] = serie
+    return pd.DataFrame(columnas)
+
+
+def escribir_parquet(df, destino):
+    """Write the processed frame as Parquet (categoricals dictionary-encoded)."""
+    _columnas_parquet(df).to_parquet(destino, index=False)
+
+
+def escribir_csv(df, destino, filas_trozo=FILAS_TROZO_CSV, cabecera=True):
+    """Write the processed frame as UTF-8 CSV, ``filas_trozo`` rows at a time.
+
+    ``destino`` may be a binary file already open, e.g. to append rows
+    without the ``cabecera`` line.
+    """
+    df.to_csv(destino, index=False, header=cabecera, chunksize=filas_trozo, date_format='%Y-%m-%d', encoding='utf-8')
+
+
+def formato_salida(ruta, por_defecto='xlsx'):
+    """Export format given by the extension of ``ruta`` (``por_defecto`` if unknown)."""
+    extension = os.path.splitext(str(ruta))[1].lower().lstrip('.')
+    return extension if extension in FORMATOS_SALIDA else por_defecto
+
+
+def escribir_salida(df, destino, formato='xlsx', hojas_extra=None):
+    """Write the output in ``formato`` (one of FORMATOS_SALIDA).
+
+    Only the xlsx, meant for people, is formatted and gets ``hojas_extra``;
+    Parquet and CSV hold just the columns of ``df``, for loaders.
+    """
+    if formato == 'parquet':
+        escribir_parquet(df, destino)
+    elif formato == 'csv':
+        escribir_csv(df, destino)
+    elif formato == 'xlsx':
+        escribir_excel(df, destino, hojas_extra=hojas_extra)
+    else:
+        raise ValueError(f"Formato de salida desconocido: {formato}")
+
+
+# Bump whenever reading or header detection changes, so cached sheets are
+# not reused with a different parser
+VERSION_LECTOR = 1
+
+
+def huella_fichero(origen):
+    """SHA-256 of a file (path or binary file object) read in chunks.
+
+    A file object is hashed from its start and left at the position it had.
+    """
+    sha = hashlib.sha256()
+    if isinstance(origen, (str, os.PathLike)):
+        with open(origen, 'rb') as f:
+            for trozo in iter(lambda: f.read(1 << 20), b''):
+                sha.update(trozo)
+    else:
+        posicion = origen.tell()
+        origen.seek(0)
+        for trozo in iter(lambda: origen.read(1 << 20), b''):
+            sha.update(trozo)
+        origen.seek(posicion)
+    return sha.hexdigest()
+
+
+def _tipo_celda(valor):
+    if isinstance(valor, bool):
+        return 'b'
+    if isinstance(valor, (int, np.integer)):
+        return 'i'
+    if isinstance(valor, (float, np.floating)):
+        return 'f'
+    if isinstance(valor, (datetime.datetime, np.datetime64)):
+        return 't'
+    return 's'
+
+
+_TIPOS_PARTE = {'b': 'boolean', 'i': 'Int64', 'f': 'float64', 't': 'datetime64[ns]', 's': 'str'}
+
+
+def _codificar_hoja(df):
+    """Split the raw sheet into Parquet-friendly typed columns.
+
+    Typed columns are stored as they are. Mixed object columns are split
+    into one column per cell type ('3:s', '3:f', …), each holding the
+    values of that type and nulls elsewhere; other types are kept as text.
+    """
+    partes = {}
+    esquema = {}
+    for col in range(df.shape[1]):
+        serie = df.iloc[:, col]
+        if serie.dtype != object:
+            partes[str(col)] = serie.reset_index(drop=True)
+            esquema[str(col)] = []
+            continue
+        tipos = serie.map(_tipo_celda, na_action='ignore')
+        esquema[str(col)] = sorted(tipos.dropna().unique())
+        for tipo in esquema[str(col)]:
+            parte = serie.where(tipos == tipo)
+            if tipo == 's':
+                parte = parte.map(str, na_action='ignore')
+            partes[f"{col}:{tipo}"] = parte.astype(_TIPOS_PARTE[tipo]).reset_index(drop=True)
+    return pd.DataFrame(partes, index=range(len(df))), esquema
+
+
+def _decodificar_hoja(tabla, esquema):
+    columnas = {}
+    for col, tipos in esquema.items():
+        if not tipos:
+            columnas[int(col)] = tabla[col]
+            continue
+        valores = np.full(len(tabla), np.nan, dtype=object)
+        for tipo in tipos:
+            parte = tabla[f"{col}:{tipo}"]
+            presentes = parte.notna().to_numpy()
+            if tipo == 't':
+                # pd.read_excel leaves datetime objects in mixed columns
+                valores[presentes] = [valor.to_pydatetime() for valor in parte[presentes]]
+            else:
+                valores[presentes] = parte[presentes].astype(object).to_numpy()
+        columnas[int(col)] = valores
+    return pd.DataFrame(columnas, index=range(len(tabla)))
+
+
+class CacheHojas:
+    """On-disk cache of parsed sheets and their header map.
+
+    Each entry is a Parquet file with the raw sheet plus a JSON file with
+    the header map, named after the file hash and VERSION_LECTOR. Hits
+    refresh the entry's mtime and the oldest entries are evicted once the
+    directory grows over ``max_mb``. Cache failures never stop processing,
+    they only emit a warning.
+    """
+
+    def __init__(self, directorio=DIRECTORIO_CACHE, max_mb=MAX_MB_CACHE):
+        self.directorio = directorio
+        self.max_bytes = max_mb * 1024 * 1024
+
+    def _rutas(self, huella):
+        base = os.path.join(self.directorio, f"{huella}-v{VERSION_LECTOR}")
+        return f"{base}.parquet", f"{base}.json"
+
+    def cargar(self, huella):
+        """Return ``(df, cabecera)`` for a cached sheet, or None."""
+        ruta_hoja, ruta_meta = self._rutas(huella)
+        if not (os.path.exists(ruta_hoja) and os.path.exists(ruta_meta)):
+            return None
+        try:
+            with open(ruta_meta, encoding='utf-8') as f:
+                meta = json.load(f)
+            df = _decodificar_hoja(pd.read_parquet(ruta_hoja), meta['esquema'])
+            ahora = time.time()
+            for ruta in (ruta_hoja, ruta_meta):
+                os.utime(ruta, (ahora, ahora))
+        except Exception as e:
+            warnings.warn(f"No se pudo leer la caché {ruta_hoja}: {e}")
+            return None
+        return df, (meta['cabecera']['columnas'], meta['cabecera']['header_row'])
+
+    def guardar(self, huella, df, cabecera):
+        ruta_hoja, ruta_meta = self._rutas(huella)
+        try:
+            os.makedirs(self.directorio, exist_ok=True)
+            tabla, esquema = _codificar_hoja(df)
+            # The JSON goes last and marks the entry complete
+            escribir_atomico(ruta_hoja, lambda temporal: tabla.to_parquet(temporal, index=False))
+            meta = {
+                'version': VERSION_LECTOR,
+                'esquema': esquema,
+                'cabecera': {'columnas': cabecera[0], 'header_row': cabecera[1]},
+            }
+            escribir_json(ruta_meta, meta)
+            self._recortar()
+        except Exception as e:
+            warnings.warn(f"No se pudo guardar la caché {ruta_hoja}: {e}")
+
+    def _entradas(self):
+        """Cached entries as ``(último uso, bytes, rutas)``, oldest first."""
+        if not os.path.isdir(self.directorio):
+            return []
+        entradas = {}
+        for nombre in os.listdir(self.directorio):
+            ruta = os.path.join(self.directorio, nombre)
+            try:
+                estado = os.stat(ruta)
+            except FileNotFoundError:
+                continue
+            uso, tamano, rutas = entradas.get(nombre.split('.')[0], (0, 0, []))
+            entradas[nombre.split('.')[0]] = (max(uso, estado.st_mtime), tamano + estado.st_size, rutas + [ruta])
+        return sorted(entradas.values())
+
+    @staticmethod
+    def _borrar(rutas):
+        for ruta in rutas:
+            try:
+                os.remove(ruta)
+            except FileNotFoundError:
+                pass
+
+    def _recortar(self):
+        # Least recently used entries go first
+        entradas = self._entradas()
+        total = sum(tamano for _, tamano, _ in entradas)
+        for _, tamano, rutas in entradas:
+            if total <= self.max_bytes:
+                break
+            self._borrar(rutas)
+            total -= tamano
+
+    def limpiar(self):
+        for _, _, rutas in self._entradas():
+            self._borrar(rutas)
+
+
+def leer_hoja(entrada, plantilla=None, cache=None, huella=None, perfil=None):
+    """Read the raw sheet (header=None) and its header map.
+
+    With a ``cache`` the parsed sheet is loaded from disk when the file has
+    not changed (``huella`` avoids hashing it again), and stored after a
+    fresh read otherwise. Returns ``(df, cabecera)``.
+    """
+    perfil = perfil or Perfil()
+    if cache is not None:
+        with perfil.etapa('caché') as registro:
+            huella = huella or huella_fichero(entrada)
+            guardada = cache.cargar(huella)
+            registro['filas_salida'] = 0 if guardada is None else len(guardada[0])
+        if guardada is not None:
+            df, cabecera = guardada
+            if plantilla and plantilla not in cargar_plantillas():
+                guardar_plantilla(plantilla, *cabecera)
+            return df, cabecera
+
+    with perfil.etapa('lectura') as registro:
+        df = pd.read_excel(entrada, header=None)
+        registro['filas_salida'] = len(df)
+    with perfil.etapa('cabecera', len(df)):
+        cabecera = localizar_cabecera(df, plantilla)
+    if cache is not None:
+        with perfil.etapa('guardar caché', len(df)):
+            cache.guardar(huella, df, cabecera)
+    return df, cabecera
+
+
+# ------------------------------------------------------------------------ #
+# Per-stage instrumentation
+
+# tracemalloc is process-wide: only one stage at a time may measure it (the
+# Streamlit app runs the tasks of several sessions on threads)
+_MEMORIA_EN_USO = threading.Lock()
+
+
+class Perfil:
+    """Wall time, rows in/out and peak memory of each pipeline stage.
+
+    Stages are recorded in order with ``with perfil.etapa(nombre, filas):``
+    and must not nest; the context yields the stage record so the caller
+    can set its 'filas_salida'. Parts of a stage measured by the code it
+    runs (e.g. each filter rule inside the combining) are added after it
+    with ``subetapa`` and left out of the total. Peak memory (MB allocated
+    above the level at the start of the stage) comes from tracemalloc and is
+    only measured with ``memoria=True``, as tracing slows pandas code down
+    several times; a stage that starts while another thread is measuring is
+    left without it ('pico_mb' None) rather than corrupting both readings.
+    """
+
+    COLUMNAS = ['etapa', 'segundos', 'filas_entrada', 'filas_salida', 'pico_mb']
+
+    def __init__(self, memoria=False):
+        self.memoria = memoria
+        self.etapas = []
+
+    @contextmanager
+    def etapa(self, nombre, filas_entrada=None):
+        registro = dict.fromkeys(self.COLUMNAS)
+        registro.update(etapa=nombre, filas_entrada=filas_entrada)
+        memoria = self.memoria and _MEMORIA_EN_USO.acquire(blocking=False)
+        propio = memoria and not tracemalloc.is_tracing()
+        if propio:
+            tracemalloc.start()
+        elif memoria:
+            tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0] if memoria else 0
+        inicio = time.perf_counter()
+        try:
+            yield registro
+        finally:
+            registro['segundos'] = time.perf_counter() - inicio
+            if memoria:
+                registro['pico_mb'] = (tracemalloc.get_traced_memory()[1] - base) / 2**20
+                if propio:
+                    tracemalloc.stop()
+                _MEMORIA_EN_USO.release()
+            self.etapas.append(registro)
+
+    def subetapa(self, nombre, segundos, filas_entrada=None, filas_salida=None):
+        """Record a part of the previous stage, already timed by its caller."""
+        registro = dict.fromkeys(self.COLUMNAS)
+        registro.update(etapa=nombre, segundos=segundos, filas_entrada=filas_entrada, filas_salida=filas_salida, subetapa=True)
+        self.etapas.append(registro)
+
+    @staticmethod
+    def total(etapas):
+        """Seconds of the stages in ``etapas``, without counting sub-stages twice."""
+        return sum(registro['segundos'] for registro in etapas if not registro.get('subetapa'))
+
+    def informe(self):
+        """Plain-text table of the recorded stages, with the total time."""
+        lineas = [f"{'Etapa':24} {'Tiempo (s)':>11} {'Filas entrada':>14} {'Filas salida':>13} {'Pico (MB)':>10}"]
+        for registro in self.etapas:
+            filas = [registro[clave] for clave in ('filas_entrada', 'filas_salida')]
+            pico = registro['pico_mb']
+            nombre = f"  {registro['etapa']}" if registro.get('subetapa') else registro['etapa']
+            lineas.append(
+                f"{nombre:24} {registro['segundos']:11.3f} "
+                + ' '.join(f"{'' if valor is None else valor:>{ancho}}" for valor, ancho in zip(filas, (14, 13)))
+                + f" {'' if pico is None else f'{pico:.1f}':>10}"
+            )
+        lineas.append(f"{'Total':24} {self.total(self.etapas):11.3f}")
+        return '\n'.join(lineas)
+
+
+# ------------------------------------------------------------------------ #
+# Incremental mode: combine only the rows added since the last run
+
+# Cells fingerprinted to tell whether the sheet rows already processed changed
+CAMPOS_CLAVE = ['Documento', 'Fecha', 'Referencia']
+
+
+def _texto_clave(valor):
+    # Whole floats as integers: a cell reads as 5 or 5.0 depending on the
+    # other cells of its block
+    if isinstance(valor, float) and valor.is_integer():
+        return str(int(valor))
+    return str(valor)
+
+
+def claves_movimiento(valores, columnas):
+    """'Documento|Fecha|Referencia' of each raw row (empty cells as '')."""
+    ancho = max(columnas[campo] for campo in CAMPOS_CLAVE) + 1
+    if valores.shape[1] < ancho:
+        valores = _apilar(list(valores), ancho)
+    partes = []
+    for campo in CAMPOS_CLAVE:
+        celdas = pd.Series(valores[:, columnas[campo]], dtype=object)
+        partes.append(celdas.map(_texto_clave, na_action='ignore').fillna('').str.strip())
+    return (partes[0] + '|' + partes[1] + '|' + partes[2].str.upper()).to_numpy(dtype=object)
+
+
+def _hashes_claves(valores, columnas):
+    # One 64-bit hash per raw row (deterministic: pandas hashes with a fixed key)
+    return pd.util.hash_array(claves_movimiento(valores, columnas))
+
+
+def _huella_hashes(hashes, filas):
+    # Fingerprint of the first ``filas`` rows hashed
+    todos = np.concatenate(hashes) if hashes else np.empty(0, dtype=np.uint64)
+    return hashlib.sha256(todos[:filas].tobytes()).hexdigest()
+
+
+def filas_definitivas(df):
+    """Mask of the output rows (in sheet order) that later exports cannot change.
+
+    A product without LOT after the last one that has a LOT was closed by
+    the end of the sheet, so its LOT line may still come in a later export.
+    Every product before a LOT match has been settled for good.
+    """
+    con_lote = (df['LOT'] != '').to_numpy()
+    ultima = np.flatnonzero(con_lote)[-1] if con_lote.any() else -1
+    return con_lote | (np.arange(len(df)) < ultima)
+
+
+class PuntoControl:
+    """Checkpoint of the incremental mode for one output.
+
+    Holds the output rows later exports cannot change (see
+    ``filas_definitivas``) as ``<ruta>.parquet``, plus ``<ruta>.json`` with
+    their column names and types, the header columns, the sheet position
+    right after the last of those rows (``reanudar``) and a fingerprint of
+    the key cells (CAMPOS_CLAVE) of every sheet row before it. The next run
+    checks the fingerprint and only combines the rows from that position
+    on; a missing, unreadable or outdated checkpoint means a full run.
+
+    A run calls ``cargar``, then ``reanudar`` on the raw sheet, passes
+    ``registrar`` to ``combinar_tabla`` (``registrar_filas``), ``fusionar``
+    the rows it produced and, once the output is written, ``guardar``.
+    """
+
+    def __init__(self, ruta):
+        self.ruta_tabla = f"{ruta}.parquet"
+        self.ruta_meta = f"{ruta}.json"
+        self.previo = None
+        self.estado = {}
+        self.columnas = None
+        self.hashes = []
+        self.definitivas = 0
+        self.siguiente = 0
+
+    def cargar(self):
+        """Load the checkpoint; returns its rows, or None when there is none to use."""
+        self.previo, self.estado = None, {}
+        if not (os.path.exists(self.ruta_tabla) and os.path.exists(self.ruta_meta)):
+            return None
+        try:
+            with open(self.ruta_meta, encoding='utf-8') as f:
+                meta = json.load(f)
+            df = _decodificar_hoja(pd.read_parquet(self.ruta_tabla), meta['esquema'])
+            df.columns = meta['columnas']
+            self.estado = {campo: meta[campo] for campo in ('reanudar', 'huella', 'columnas_hoja', 'salida')}
+        except Exception as e:
+            warnings.warn(f"No se pudo leer el punto de control {self.ruta_tabla}: {e}")
+            return None
+        self.previo = df
+        return df
+
+    @property
+    def filas_previas(self):
+        """Output rows kept from the checkpoint (the first rows of this run's output)."""
+        return 0 if self.previo is None else len(self.previo)
+
+    def reanudar(self, origen):
+        """Skip the rows of ``origen`` (a raw sheet, as combinar_tabla takes it) already settled.
+
+        Returns ``(resto, cabecera, inicio)``: the rows from the checkpoint's
+        position on, the header to combine them with and that position, when
+        the key cells before it are unchanged. Returns None otherwise, and
+        the checkpoint is dropped; a row iterator has then been partly
+        consumed and has to be opened again for the full run.
+        """
+        if self.previo is None:
+            return None
+        inicio = self.estado['reanudar']
+        columnas = self.estado['columnas_hoja']
+        hashes = []
+        if isinstance(origen, pd.DataFrame):
+            leidas = min(inicio, len(origen))
+            hashes.append(_hashes_claves(origen.iloc[:leidas].to_numpy(dtype=object), columnas))
+            resto = origen.iloc[leidas:]
+        else:
+            resto = iter(origen)
+            leidas = 0
+            while leidas < inicio:
+                bloque = list(islice(resto, min(TAMANO_BLOQUE, inicio - leidas)))
+                if not bloque:
+                    break
+                leidas += len(bloque)
+                filas = [np.array(fila, dtype=object) for fila in bloque]
+                hashes.append(_hashes_claves(_apilar(filas, max(len(fila) for fila in filas)), columnas))
+        if leidas < inicio or _huella_hashes(hashes, inicio) != self.estado['huella']:
+            self.previo, self.estado = None, {}
+            return None
+        self.columnas, self.hashes = columnas, hashes
+        # The header row itself is not needed to combine
+        return resto, (columnas, None), inicio
+
+    def registrar(self, valores, columnas):
+        """Fingerprint the key cells of one block of combined rows (in sheet order)."""
+        self.columnas = columnas
+        self.hashes.append(_hashes_claves(valores, columnas))
+
+    def fusionar(self, nuevo, posiciones):
+        """Checkpointed rows followed by the ones of this run (``nuevo``, at sheet ``posiciones``)."""
+        previo = self.previo
+        df = nuevo
+        if previo is not None:
+            df = pd.concat([previo, nuevo], ignore_index=True)
+            # Categories differ between runs, so concat falls back to object
+            for columna in nuevo.select_dtypes('category').columns:
+                df[columna] = df[columna].astype('category')
+        self.definitivas = int(filas_definitivas(df).sum())
+        if self.definitivas > self.filas_previas:
+            self.siguiente = int(posiciones[self.definitivas - self.filas_previas - 1]) + 1
+        else:
+            self.siguiente = self.estado.get('reanudar', 0)
+        return df
+
+    def guardar(self, df, salida=None):
+        """Save the definitive rows of ``df`` (as returned by ``fusionar``) and where to resume.
+
+        ``salida`` is kept as is for the writer of the output (e.g. where a
+        CSV output ends its definitive rows) and returned by ``cargar`` in
+        ``estado['salida']``.
+        """
+        tabla, esquema = _codificar_hoja(df.iloc[:self.definitivas])
+        meta = {
+            'columnas': list(df.columns),
+            'esquema': esquema,
+            'reanudar': self.siguiente,
+            'huella': _huella_hashes(self.hashes, self.siguiente),
+            'columnas_hoja': {campo: int(columna) for campo, columna in (self.columnas or {}).items()},
+            'salida': salida,
+        }
+        directorio = os.path.dirname(self.ruta_tabla)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        escribir_atomico(self.ruta_tabla, lambda temporal: tabla.to_parquet(temporal, index=False))
+        escribir_json(self.ruta_meta, meta)
+
+
+# ------------------------------------------------------------------------ #
+# LOT traceability: a SQLite index of the processed movements of every run
+
+# One row per movement key; the primary key leads with the LOT and a second
+# index with the client, so both lookups are index range scans
+_ESQUEMA_TRAZABILIDAD = """
+CREATE TABLE IF NOT EXISTS movimientos (
+    lote TEXT NOT NULL,
+    referencia TEXT NOT NULL,
+    cliente INTEGER NOT NULL,
+    fecha TEXT NOT NULL,
+    documento TEXT NOT NULL,
+    concepto TEXT NOT NULL,
+    movimientos INTEGER NOT NULL,
+    cantidad REAL,
+    litros REAL,
+    valor REAL,
+    archivo TEXT,
+    PRIMARY KEY (lote, referencia, cliente, fecha, documento, concepto)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS movimientos_cliente ON movimientos (cliente, lote);
+CREATE INDEX IF NOT EXISTS movimientos_referencia ON movimientos (referencia, fecha);
+"""
+
+# Key of the index and the output column each field comes from
+CLAVE_TRAZABILIDAD = {
+    'lote': 'LOT',
+    'referencia': 'Referencia',
+    'cliente': 'Cliente / Prov.',
+    'fecha': 'Fecha',
+    'documento': 'Documento',
+    'concepto': 'Concepto',
+}
+
+_UPSERT_TRAZABILIDAD = f"""
+INSERT INTO movimientos ({', '.join(CLAVE_TRAZABILIDAD)}, movimientos, cantidad, litros, valor, archivo)
+VALUES ({', '.join('?' * (len(CLAVE_TRAZABILIDAD) + 5))})
+ON CONFLICT ({', '.join(CLAVE_TRAZABILIDAD)}) DO UPDATE SET
+    movimientos = excluded.movimientos, cantidad = excluded.cantidad, litros = excluded.litros,
+    valor = excluded.valor, archivo = COALESCE(excluded.archivo, archivo)
+"""
+
+# A LOT written as 24 118 comes out of the search as 24118: the index keeps
+# every LOT as 24-118 so both spellings are found
+LOTE_INDICE_PATTERN = r'^(\d{2})-?(\d{3})$'
+
+# Totals of each lookup row, named like the output columns
+_TOTALES_TRAZABILIDAD = """
+    MIN(fecha) AS "Primera fecha", MAX(fecha) AS "Última fecha", SUM(movimientos) AS "Movimientos",
+    SUM(cantidad) AS "Cantidad", SUM(litros) AS "LITRES", SUM(valor) AS "VALOR"
+"""
+
+
+class IndiceTrazabilidad:
+    """SQLite index of the movements with a LOT, across every processed export.
+
+    ``actualizar`` upserts the rows of an output grouped by CLAVE_TRAZABILIDAD
+    (quantity, litres and value summed), so processing a month again
+    replaces its rows instead of counting them twice. ``clientes_de_lote``
+    and ``lotes_de_cliente`` answer recalls from the index alone, without
+    reading any workbook. The database is opened in WAL mode so lookups can
+    run while an export is being indexed.
+    """
+
+    def __init__(self, ruta=ARCHIVO_TRAZABILIDAD):
+        self.ruta = ruta
+
+    def _conectar(self):
+        directorio = os.path.dirname(self.ruta)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        conexion = sqlite3.connect(self.ruta, timeout=30)
+        conexion.execute('PRAGMA journal_mode=WAL')
+        conexion.executescript(_ESQUEMA_TRAZABILIDAD)
+        return conexion
+
+    def actualizar(self, df, archivo=None):
+        """Upsert the rows of ``df`` that have a LOT; returns the index rows written."""
+        df = df[df['LOT'].astype(str) != '']
+        if df.empty:
+            return 0
+        # The CLI and the app reach here with different dtypes (a missing
+        # Documento is NaN in one and '' in the other, Concepto keeps the
+        # export's spacing), so the text fields are normalised before they
+        # become part of the key
+        claves = {campo: df[columna].fillna('').astype(str).str.strip().replace({'nan': '', 'None': ''})
+                  for campo, columna in CLAVE_TRAZABILIDAD.items()}
+        claves['concepto'] = claves['concepto'].str.upper()
+        claves['cliente'] = df['Cliente / Prov.'].astype('int64')
+        claves['lote'] = claves['lote'].str.replace(LOTE_INDICE_PATTERN, r'\1-\2', regex=True)
+        claves['fecha'] = pd.to_datetime(df['Fecha'], errors='coerce').dt.strftime('%Y-%m-%d').fillna('')
+        filas = (pd.DataFrame({**claves, 'cantidad': df['Cantidad'], 'litros': df['LITRES'], 'valor': df['VALOR']})
+                 .groupby(list(CLAVE_TRAZABILIDAD), sort=False)
+                 .agg(movimientos=('cantidad', 'size'), cantidad=('cantidad', 'sum'),
+                      litros=('litros', 'sum'), valor=('valor', 'sum'))
+                 .reset_index())
+        filas['archivo'] = archivo
+        # Series.tolist gives Python scalars, which is what sqlite3 binds
+        registros = zip(*(filas[columna].tolist() for columna in filas.columns))
+        with closing(self._conectar()) as conexion, conexion:
+            conexion.executemany(_UPSERT_TRAZABILIDAD, registros)
+        return len(filas)
+
+    def _consultar(self, sql, parametros):
+        with closing(self._conectar()) as conexion:
+            df = pd.read_sql_query(sql, conexion, params=parametros)
+        for columna in ('Primera fecha', 'Última fecha'):
+            df[columna] = pd.to_datetime(df[columna], errors='coerce')
+        return df
+
+    def clientes_de_lote(self, lote):
+        """Clients that received ``lote`` (as written in LOT, e.g. 24-118), per reference and concept."""
+        lote = re.sub(LOTE_INDICE_PATTERN, r'\1-\2', re.sub(r'\s+', '', str(lote)))
+        return self._consultar(f"""
+            SELECT cliente AS "Cliente / Prov.", referencia AS "Referencia", concepto AS "Concepto", {_TOTALES_TRAZABILIDAD}
+            FROM movimientos WHERE lote = ?
+            GROUP BY cliente, referencia, concepto ORDER BY "Primera fecha", cliente
+        """, (lote,))
+
+    def lotes_de_cliente(self, cliente):
+        """LOTs received by client ``cliente``, per reference and concept."""
+        return self._consultar(f"""
+            SELECT lote AS "LOT", referencia AS "Referencia", concepto AS "Concepto", {_TOTALES_TRAZABILIDAD}
+            FROM movimientos WHERE cliente = ?
+            GROUP BY lote, referencia, concepto ORDER BY "Primera fecha", lote
+        """, (int(cliente),))
+
+    def resumen(self):
+        """Rows, LOTs, clients and date range held by the index."""
+        with closing(self._conectar()) as conexion:
+            filas, lotes, clientes, desde, hasta = conexion.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT lote), COUNT(DISTINCT cliente), MIN(fecha), MAX(fecha) FROM movimientos"
+            ).fetchone()
+        return {'filas': filas, 'lotes': lotes, 'clientes': clientes, 'desde': desde, 'hasta': hasta}
@@ -0,0 +1,24 @@
+"""Defaults shared by the engine and the entry points.
+
+Only plain values: the CLI builds its argument parser from them, so --help
+and usage errors answer without importing pandas or the engine.
+"""
+
+# Optional JSON file ({"sufijo": litros, ...}) that extends or overrides the
+# litres table of the engine (silice_engine.cargar_tabla_litros)
+ARCHIVO_LITROS = 'litros_referencia.json'
+
+# Output formats of silice_engine.escribir_salida
+FORMATOS_SALIDA = ['xlsx', 'parquet', 'csv']
+
+# Parsed-sheet cache (silice_engine.CacheHojas)
+DIRECTORIO_CACHE = '.silice_cache'
+MAX_MB_CACHE = 500
+
+# Watch-folder mode: seconds between scans of the folder, and the status log
+# written (atomically) next to the outputs
+INTERVALO_VIGILANCIA = 5
+ARCHIVO_ESTADO_VIGILANCIA = 'estado_vigilancia.json'
+
+# LOT traceability index (silice_engine.IndiceTrazabilidad), updated on every run
+ARCHIVO_TRAZABILIDAD = 'trazabilidad_lotes.sqlite'
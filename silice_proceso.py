@@ -0,0 +1,448 @@
+"""Processing of SILICE exports behind procesar_xls_silice_202503.py.
+
+The rule set, the record builder and the pipeline stages, plus the batch and
+watch-folder modes. Kept out of the entry script so that it only imports
+pandas and the engine once the arguments are parsed.
+"""
+import pandas as pd
+import glob
+import json
+import os
+import signal
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from silice_engine import (
+    FiltroReglas, IndiceTrazabilidad, Perfil, PuntoControl, Regla, aplicar_reglas, calcular_agregados, calcular_litros,
+    combinar_en_paralelo, combinar_tabla, convertir_columnas, escribir_atomico, escribir_csv, escribir_json,
+    escribir_salida, formato_salida, iterar_filas, leer_hoja, resumen_errores, texto_celdas,
+)
+from silice_opciones import ARCHIVO_ESTADO_VIGILANCIA, INTERVALO_VIGILANCIA
+
+# Suffix of the outputs written by the batch mode
+SUFIJO_SALIDA = '_procesado'
+
+# Sheet row of each record, kept until the numbers are parsed to report bad cells
+COLUMNA_FILA = 'Fila'
+
+# Suffix of the checkpoint kept next to each output in incremental mode
+SUFIJO_PUNTO_CONTROL = '.punto_control'
+
+# Rows kept in the output. The rules are evaluated on the raw product rows
+# before building them (see CAMPOS_REGLAS) and again on the output frame.
+REGLAS = [
+    Regla('filtro: concepto', 'Concepto', lambda concepto: concepto.isin(['SALIDA POR FACTURA', 'ENTRADA POR ABONO EN FACTURA'])),
+    Regla('filtro: ABV', 'Descripción', lambda descripcion: descripcion.str.contains('ABV', case=False, na=False)),
+    Regla('filtro: referencia E', 'Referencia', lambda referencia: referencia.str.lower().str.startswith('e', na=False)),
+]
+
+# Fields of the rules derived from the raw cells (construir_tabla builds the output ones from them too)
+CAMPOS_REGLAS = {
+    'Concepto': lambda valores, columnas: texto_celdas(valores, columnas['Concepto']).str.replace("nan", "", regex=False).str.upper().str.strip(),
+    'Descripción': lambda valores, columnas: texto_celdas(valores, columnas['Descripción']).str.replace("nan", "", regex=False).str.upper(),
+    'Referencia': lambda valores, columnas: texto_celdas(valores, columnas['Referencia']).str.upper(),
+}
+
+def celdas(valores, columnas, campo):
+    return pd.Series(valores[:, columnas[campo]], dtype=object)
+
+def construir_tabla(valores, columnas):
+    """Build the typed output columns of the product rows (the engine adds LOT).
+
+    Repeated text goes into categoricals. Date, client, quantity and price
+    are left as raw cells: they are parsed column-wise afterwards by
+    convertir_columnas, which reports the ones it cannot read.
+    """
+    return pd.DataFrame({
+        'Almacén': celdas(valores, columnas, 'Almacén').fillna('').astype('category'),
+        'Fecha': celdas(valores, columnas, 'Fecha'),
+        'Referencia': CAMPOS_REGLAS['Referencia'](valores, columnas).astype('category'),
+        'Descripción': CAMPOS_REGLAS['Descripción'](valores, columnas).astype('category'),
+        'Concepto': CAMPOS_REGLAS['Concepto'](valores, columnas).astype('category'),
+        'Documento': celdas(valores, columnas, 'Documento').fillna('').astype('category'),
+        'Cliente / Prov.': celdas(valores, columnas, 'Cliente / Prov.'),
+        'Cantidad': celdas(valores, columnas, 'Cantidad'),
+        'Precio': celdas(valores, columnas, 'Precio'),
+    })
+
+def calcular_resultado(entrada, plantilla=None, tabla_litros=None, streaming=False, cache=None, perfil=None, punto_control=None, paralelo=None):
+    """Run the processing pipeline on one export.
+
+    Returns the final DataFrame and the report of unparseable numeric cells.
+    Each stage is timed on ``perfil`` (a ``silice_engine.Perfil``) if given.
+    With a ``punto_control`` (a ``silice_engine.PuntoControl``, incremental
+    mode) the sheet rows its checkpoint settled are not combined again:
+    combining resumes where the last run left off, and the result is the
+    checkpointed rows followed by the new ones. The caller saves the
+    checkpoint once the output is written (see escribir_resultado).
+    ``paralelo`` (number of processes) combines chunks of an in-memory sheet
+    in parallel; it is ignored when streaming or in incremental mode.
+    """
+    perfil = perfil or Perfil()
+    if streaming:
+        # Stream the rows straight from the workbook, block by block
+        origen = iterar_filas(entrada)
+        cabecera = None
+        etapa = 'lectura + combinar_lotes'
+    else:
+        # Read the input file into a DataFrame (from the parsed-sheet cache when unchanged)
+        origen, cabecera = leer_hoja(entrada, plantilla, cache, perfil=perfil)
+        etapa = 'combinar_lotes'
+    
+    inicio = 0
+    registrar_filas = None
+    if punto_control is not None:
+        # Skip the rows already settled, if they have not changed since
+        with perfil.etapa('punto de control', None if streaming else len(origen)) as registro:
+            punto_control.cargar()
+            reanudacion = punto_control.reanudar(origen)
+            if reanudacion is not None:
+                origen, cabecera, inicio = reanudacion
+            elif streaming:
+                # The check may have read part of the workbook: start it again
+                origen = iterar_filas(entrada)
+            registro['filas_salida'] = punto_control.filas_previas
+        registrar_filas = punto_control.registrar
+    
+    # Combine each product row that passes the rules with its LOT (the header
+    # is located on the way if not known yet)
+    filtro = FiltroReglas(REGLAS, CAMPOS_REGLAS)
+    with perfil.etapa(etapa, None if streaming else len(origen)) as registro:
+        if paralelo and not streaming and punto_control is None:
+            df_final = combinar_en_paralelo(origen, construir_tabla, cabecera, paralelo, filtro, columna_fila=COLUMNA_FILA)
+        else:
+            df_final = combinar_tabla(origen, construir_tabla, plantilla, cabecera=cabecera, filtro=filtro, columna_fila=COLUMNA_FILA,
+                                      inicio=inicio, registrar_filas=registrar_filas)
+        registro['filas_salida'] = len(df_final)
+    filtro.registrar(perfil)
+    
+    df_final = filtrar_resultado(df_final, perfil)
+    posiciones = df_final[COLUMNA_FILA].to_numpy()
+    df_final, errores = convertir_numericos(df_final, perfil)
+    df_final = calcular_importes(df_final, tabla_litros, perfil)
+    
+    if punto_control is not None:
+        # The checkpointed rows go first: they all come before the resume position
+        with perfil.etapa('fusionar', len(df_final)) as registro:
+            df_final = punto_control.fusionar(df_final, posiciones)
+            registro['filas_salida'] = len(df_final)
+    return df_final, errores
+
+def filtrar_resultado(df_final, perfil=None):
+    """Remove rows with missing concept and apply the rule set."""
+    perfil = perfil or Perfil()
+    with perfil.etapa('limpiar concepto', len(df_final)) as registro:
+        # Concepto comes stripped from construir_tabla (a .str op would drop the categorical)
+        df_final.dropna(subset=['Concepto'], inplace=True)
+        registro['filas_salida'] = len(df_final)
+    with perfil.etapa('reglas', len(df_final)) as registro:
+        df_final = aplicar_reglas(df_final, REGLAS)
+        registro['filas_salida'] = len(df_final)
+    return df_final
+
+def convertir_numericos(df_final, perfil=None):
+    """Parse date, client, quantity and price column-wise; return the frame and the bad cells."""
+    perfil = perfil or Perfil()
+    with perfil.etapa('números', len(df_final)) as registro:
+        errores = convertir_columnas(df_final, COLUMNA_FILA)
+        df_final = df_final.drop(columns=COLUMNA_FILA)
+        registro['filas_salida'] = len(df_final)
+    return df_final, errores
+
+def calcular_importes(df_final, tabla_litros=None, perfil=None):
+    """Calculate LITRES and VALOR columns."""
+    perfil = perfil or Perfil()
+    with perfil.etapa('litros', len(df_final)) as registro:
+        df_final['LITRES'] = (calcular_litros(df_final['Referencia'], tabla_litros) * df_final['Cantidad']).abs()
+        df_final['VALOR'] = (df_final['Cantidad'] * df_final['Precio']).abs()
+        registro['filas_salida'] = len(df_final)
+    return df_final
+
+def calcular_resumenes(df_final, perfil=None):
+    """KPIs and summary sheets of the output, from one groupby pass."""
+    perfil = perfil or Perfil()
+    with perfil.etapa('agregados', len(df_final)):
+        return calcular_agregados(df_final)
+
+def indexar_lotes(df_final, trazabilidad, entrada, perfil=None):
+    """Upsert the output into the LOT traceability index ``trazabilidad`` (a path).
+
+    A failure only warns: the output is already written.
+    """
+    perfil = perfil or Perfil()
+    with perfil.etapa('trazabilidad', len(df_final)) as registro:
+        try:
+            registro['filas_salida'] = IndiceTrazabilidad(trazabilidad).actualizar(df_final, os.path.basename(entrada))
+        except Exception as e:
+            warnings.warn(f"No se pudo actualizar el índice de trazabilidad {trazabilidad}: {e}")
+
+def ruta_punto_control(salida):
+    return os.path.splitext(salida)[0] + SUFIJO_PUNTO_CONTROL
+
+def anadir_csv(df_final, salida, punto_control):
+    """Update a CSV output in place, rewriting only what follows the checkpointed rows.
+
+    The previous run recorded where those rows end in the file and the size
+    it left the file with; a file that does not match (missing, or changed
+    since) is written whole. Returns what the checkpoint records for the
+    next run.
+    """
+    anterior = punto_control.estado.get('salida') if punto_control.filas_previas else None
+    try:
+        tamano = os.path.getsize(salida)
+    except OSError:
+        tamano = None
+    if anterior and tamano == anterior['total']:
+        previas, corte = punto_control.filas_previas, anterior['definitivas']
+    else:
+        previas, corte = 0, 0
+    with open(salida, 'r+b' if corte else 'wb') as f:
+        f.seek(corte)
+        f.truncate()
+        escribir_csv(df_final.iloc[previas:punto_control.definitivas], f, cabecera=not corte)
+        definitivas = f.tell()
+        escribir_csv(df_final.iloc[punto_control.definitivas:], f, cabecera=False)
+        return {'definitivas': definitivas, 'total': f.tell()}
+
+def escribir_resultado(df_final, salida, resumenes, punto_control=None, atomico=False):
+    """Write the output and then, in incremental mode, save its checkpoint.
+
+    In incremental mode a CSV output only gets the rows after the
+    checkpointed ones (anadir_csv); the other formats are written whole.
+    With ``atomico`` they are written to a temporary file and renamed, so
+    whoever watches the output folder never reads a half-written file.
+    """
+    if punto_control is not None and formato_salida(salida) == 'csv':
+        punto_control.guardar(df_final, anadir_csv(df_final, salida, punto_control))
+        return
+    def escribir(destino):
+        escribir_salida(df_final, destino, formato_salida(salida), hojas_extra=resumenes)
+    if atomico:
+        escribir_atomico(salida, escribir)
+    else:
+        escribir(salida)
+    if punto_control is not None:
+        punto_control.guardar(df_final)
+
+def procesar_xls(entrada, salida, plantilla=None, tabla_litros=None, streaming=False, cache=None, perfil=None, incremental=False, paralelo=None, trazabilidad=None):
+    perfil = perfil or Perfil()
+    try:
+        punto_control = PuntoControl(ruta_punto_control(salida)) if incremental else None
+        df_final, errores = calcular_resultado(entrada, plantilla, tabla_litros, streaming, cache, perfil, punto_control, paralelo)
+        indicadores, resumenes = calcular_resumenes(df_final, perfil)
+        
+        # Export to Excel with frozen header, filters and formats in one pass,
+        # with a sheet per summary (Parquet and CSV get just the columns)
+        with perfil.etapa('escritura', len(df_final)):
+            escribir_resultado(df_final, salida, resumenes, punto_control)
+        if trazabilidad:
+            indexar_lotes(df_final, trazabilidad, entrada, perfil)
+        
+        print(f"Procesamiento completado. Salida guardada en: {salida}")
+        print(f"Registros: {indicadores['registros']} (sin LOT: {indicadores['sin_lote']}), "
+              f"LITRES: {indicadores['litros']:,.2f}, VALOR: {indicadores['valor']:,.2f}")
+        if not errores.empty:
+            print(resumen_errores(errores))
+    
+    except Exception as e:
+        print(f"Error durante el procesamiento: {e}")
+
+# ------------------------------------------------------------------------ #
+# Batch mode: many exports at once on a process pool
+
+def buscar_entradas(patron):
+    """Expand a directory or glob pattern into the list of exports to process."""
+    if os.path.isdir(patron):
+        patron = os.path.join(patron, '*.xls*')
+    entradas = []
+    for ruta in sorted(glob.glob(patron)):
+        nombre = os.path.basename(ruta)
+        # Skip Excel lock files and our own outputs
+        if nombre.startswith('~$') or os.path.splitext(nombre)[0].endswith(SUFIJO_SALIDA):
+            continue
+        if os.path.splitext(nombre)[1].lower() in ('.xls', '.xlsx'):
+            entradas.append(ruta)
+    return entradas
+
+def ruta_salida(entrada, salida_dir=None, formato='xlsx'):
+    base = os.path.splitext(os.path.basename(entrada))[0]
+    return os.path.join(salida_dir or os.path.dirname(entrada), f"{base}{SUFIJO_SALIDA}.{formato}")
+
+def procesar_fichero_lote(entrada, salida, opciones, devolver_resultado=False, perfilar=False):
+    """Worker of the batch mode: never raises, returns the status of one file."""
+    inicio = time.perf_counter()
+    perfil = Perfil(memoria=perfilar)
+    estado = {'entrada': entrada, 'salida': salida, 'ok': False, 'filas': 0, 'error': '', 'resultado': None, 'perfil': None, 'errores': None}
+    opciones = dict(opciones)
+    # Files are already processed in parallel: each one is combined in a single pass
+    opciones.pop('paralelo', None)
+    if opciones.pop('incremental', False):
+        opciones['punto_control'] = PuntoControl(ruta_punto_control(salida))
+    trazabilidad = opciones.pop('trazabilidad', None)
+    try:
+        df_final, errores = calcular_resultado(entrada, perfil=perfil, **opciones)
+        _, resumenes = calcular_resumenes(df_final, perfil)
+        with perfil.etapa('escritura', len(df_final)):
+            escribir_resultado(df_final, salida, resumenes, opciones.get('punto_control'), atomico=True)
+        if trazabilidad:
+            indexar_lotes(df_final, trazabilidad, entrada, perfil)
+        estado.update(ok=True, filas=len(df_final), errores=errores)
+        if devolver_resultado:
+            estado['resultado'] = df_final
+    except Exception as e:
+        estado['error'] = f"{type(e).__name__}: {e}"
+    if perfilar:
+        estado['perfil'] = perfil.informe()
+    estado['segundos'] = time.perf_counter() - inicio
+    return estado
+
+def imprimir_estado(estado):
+    """Print the status line of one file of the batch or watch-folder mode."""
+    if estado['ok']:
+        print(f"  OK     {estado['entrada']} -> {estado['salida']} ({estado['filas']} filas, {estado['segundos']:.1f} s)")
+        if not estado['errores'].empty:
+            print(resumen_errores(estado['errores'], max_filas=5))
+    else:
+        print(f"  ERROR  {estado['entrada']}: {estado['error']}")
+    if estado['perfil']:
+        print(estado['perfil'])
+
+def procesar_lote(patron, salida_dir=None, consolidado=None, procesos=None, perfilar=False, formato='xlsx', **opciones):
+    """Process every export matching ``patron`` on a process pool.
+
+    Writes one output per input (``<nombre>_procesado.<formato>``) and, if
+    ``consolidado`` is given, a merged output with an 'Archivo' column (in
+    the format of its extension, ``formato`` if it has none we know).
+    Prints a status line per file (and its stage timings with ``perfilar``)
+    and returns the list of statuses.
+    """
+    entradas = buscar_entradas(patron)
+    if not entradas:
+        print(f"No se encontraron exportaciones en: {patron}")
+        return []
+    if salida_dir:
+        os.makedirs(salida_dir, exist_ok=True)
+    
+    procesos = min(procesos or os.cpu_count() or 1, len(entradas))
+    print(f"Procesando {len(entradas)} ficheros con {procesos} procesos...")
+    
+    estados = []
+    with ProcessPoolExecutor(max_workers=procesos) as pool:
+        futuros = [
+            pool.submit(procesar_fichero_lote, entrada, ruta_salida(entrada, salida_dir, formato), opciones, consolidado is not None, perfilar)
+            for entrada in entradas
+        ]
+        for futuro in as_completed(futuros):
+            estado = futuro.result()
+            estados.append(estado)
+            imprimir_estado(estado)
+    
+    # Keep the input order for the summary and the consolidated output
+    estados.sort(key=lambda estado: entradas.index(estado['entrada']))
+    correctos = [estado for estado in estados if estado['ok']]
+    print(f"Completados {len(correctos)} de {len(estados)} ficheros.")
+    
+    if consolidado and correctos:
+        partes = [estado['resultado'].assign(Archivo=os.path.basename(estado['entrada'])) for estado in correctos]
+        df_consolidado = pd.concat(partes, ignore_index=True)
+        escribir_salida(df_consolidado, consolidado, formato_salida(consolidado, formato),
+                        hojas_extra=calcular_resumenes(df_consolidado)[1])
+        print(f"Salida consolidada guardada en: {consolidado}")
+    return estados
+
+# ------------------------------------------------------------------------ #
+# Watch-folder mode: one long-running process keeps the imports and a pool of
+# workers warm, and processes every export dropped into a folder
+
+def firma_fichero(ruta):
+    """Size and modification time of a file (None if it is gone)."""
+    try:
+        datos = os.stat(ruta)
+    except OSError:
+        return None
+    return [datos.st_size, datos.st_mtime_ns]
+
+def cargar_estado_vigilancia(ruta):
+    if not os.path.exists(ruta):
+        return {}
+    with open(ruta, encoding='utf-8') as f:
+        return json.load(f)
+
+def guardar_estado_vigilancia(ruta, estados):
+    # Written atomically, so the log can be read at any time
+    escribir_json(ruta, estados, indent=2)
+
+def _detener(signum, frame):
+    raise KeyboardInterrupt
+
+def vigilar(directorio, salida_dir=None, procesos=None, formato='xlsx', intervalo=INTERVALO_VIGILANCIA, ciclos=None, **opciones):
+    """Process every export that appears or changes in ``directorio`` until interrupted.
+
+    The folder is scanned every ``intervalo`` seconds; a file is processed
+    once its size and modification time hold for a whole interval (the ERP
+    may still be writing it), on a pool of ``procesos`` workers that stay
+    alive between files. Outputs are named as in the batch mode. The status
+    of each file (its signature, output, rows or error) goes to a JSON log
+    next to the outputs, rewritten atomically after each file; files whose
+    signature is already logged are not processed again, also after a
+    restart. ``ciclos`` limits the number of scans. Stops cleanly on Ctrl+C
+    or SIGTERM (a service manager stopping it).
+    """
+    signal.signal(signal.SIGTERM, _detener)
+    destino = salida_dir or directorio
+    os.makedirs(destino, exist_ok=True)
+    ruta_estado = os.path.join(destino, ARCHIVO_ESTADO_VIGILANCIA)
+    estados = cargar_estado_vigilancia(ruta_estado)
+    procesos = procesos or os.cpu_count() or 1
+    print(f"Vigilando {directorio} con {procesos} procesos (Ctrl+C para terminar)...")
+    
+    anteriores = {}
+    en_curso = {}
+    
+    def registrar_terminados():
+        # Log the files finished so far; cancelled ones, or ones whose worker
+        # died, stay out of the log and are processed again
+        for futuro in [futuro for futuro in en_curso if futuro.done()]:
+            nombre, firma = en_curso.pop(futuro)
+            if futuro.cancelled() or futuro.exception() is not None:
+                continue
+            estado = futuro.result()
+            imprimir_estado(estado)
+            estados[nombre] = {
+                'firma': firma, 'ok': estado['ok'], 'salida': estado['salida'], 'filas': estado['filas'],
+                'error': estado['error'], 'segundos': round(estado['segundos'], 2),
+                'procesado': time.strftime('%Y-%m-%d %H:%M:%S'),
+            }
+            guardar_estado_vigilancia(ruta_estado, estados)
+    
+    pool = ProcessPoolExecutor(max_workers=procesos)
+    try:
+        ciclo = 0
+        while ciclos is None or ciclo < ciclos:
+            registrar_terminados()
+            
+            # Queue the new or changed files that did not change since the previous scan
+            ocupados = {nombre for nombre, _ in en_curso.values()}
+            actuales = {}
+            for entrada in buscar_entradas(directorio):
+                nombre = os.path.basename(entrada)
+                firma = firma_fichero(entrada)
+                if firma is None:
+                    continue
+                actuales[nombre] = firma
+                registrado = estados.get(nombre)
+                if ((registrado is None or registrado['firma'] != firma)
+                        and nombre not in ocupados and anteriores.get(nombre) == firma):
+                    futuro = pool.submit(procesar_fichero_lote, entrada, ruta_salida(entrada, salida_dir, formato), opciones)
+                    en_curso[futuro] = (nombre, firma)
+            anteriores = actuales
+            
+            ciclo += 1
+            time.sleep(intervalo)
+    except KeyboardInterrupt:
+        print("Vigilancia detenida.")
+    finally:
+        # Queued files are dropped; the ones already running finish and are logged
+        pool.shutdown(cancel_futures=True)
+        registrar_terminados()
+    return estados
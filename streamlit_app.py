@@ -1,318 +1,522 @@
 import streamlit as st
 import pandas as pd
-import re
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import warnings
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 from io import BytesIO
-from openpyxl import load_workbook
-from openpyxl.utils.dataframe import dataframe_to_rows
+from silice_engine import (
+    CacheHojas, FiltroReglas, Perfil, Regla, aplicar_reglas, calcular_agregados, calcular_litros, combinar_tabla, convertir_columnas,
+    IndiceTrazabilidad, escribir_atomico, escribir_salida, huella_fichero, iterar_filas, leer_hoja, texto_celdas,
+)
+from silice_opciones import ARCHIVO_TRAZABILIDAD
 
 # ------------------------------------------------------------------------ #
 # FUNCIÓN DE PROCESAMIENTO DE EXCEL (ADAPTADA PARA STREAMLIT)
-def get_litres_referencia(referencia, concepto):
-    if not isinstance(referencia, str):
-        return 0.0
-    
-    # Convert reference to uppercase
-    referencia = referencia.upper()
-    
-    def extract_suffix(ref):
-        match = re.search(r'(\d+)[CI]?$', ref)
-        return match.group(1) if match else ""
+# Fila de la hoja de cada registro, para señalar las celdas no válidas
+COLUMNA_FILA = 'Fila'
+
+# Reglas de la salida, en orden. Los filtros se evalúan sobre las filas de
+# producto antes de construir los registros (ver CAMPOS_REGLAS) y todas las
+# reglas se aplican después sobre el resultado.
+REGLAS = [
+    # 1) Incluir también "Salida por Intercambio"
+    Regla('filtro: concepto', 'Concepto', lambda concepto: concepto.isin(['Salida por Factura', 'Entrada por abono en Factura', 'Salida por Intercambio'])),
+    # 2) Forzar Cliente=2734 SOLO para "Salida por Intercambio"
+    Regla('cliente intercambio', 'Concepto', lambda concepto: concepto.str.strip().str.lower().eq('salida por intercambio'), asignar={'Cliente / Prov.': 2734}),
+    Regla('filtro: ABV', 'Descripción', lambda descripcion: descripcion.str.contains('ABV', case=False, na=False)),
+    Regla('filtro: referencia E', 'Referencia', lambda referencia: referencia.str.lower().str.startswith('e', na=False)),
+]
+
+def texto_y_siguiente(valores, columna, limpiar=False):
+    # Texto de la celda unido al de la siguiente columna (si existe)
+    partes = [pd.Series(valores[:, c], dtype=object).map(str) for c in (columna, columna + 1) if c < valores.shape[1]]
+    if limpiar:
+        partes = [parte.str.strip() for parte in partes]
+    texto = partes[0]
+    for parte in partes[1:]:
+        texto = texto + " " + parte
+    return texto
+
+# Campos de las reglas calculados a partir de las celdas (construir_tabla también los usa)
+CAMPOS_REGLAS = {
+    'Concepto': lambda valores, columnas: texto_y_siguiente(valores, columnas['Concepto'], limpiar=True).str.replace("nan", "", regex=False).str.strip(),
+    'Descripción': lambda valores, columnas: texto_y_siguiente(valores, columnas['Descripción']).str.replace("nan", "", regex=False).str.strip(),
+    'Referencia': lambda valores, columnas: texto_celdas(valores, columnas['Referencia']).str.upper(),
+}
+
+def construir_tabla(valores, columnas):
+    # Columnas tipadas de las filas de producto (el motor añade el LOT): los
+    # textos repetidos como categorías. Fecha, cliente, cantidad y precio se
+    # convierten después por columnas (convertir_columnas)
+    def celdas(campo):
+        return pd.Series(valores[:, columnas[campo]], dtype=object)
+
+    return pd.DataFrame({
+        'Almacén': celdas('Almacén').astype('category'),
+        'Fecha': celdas('Fecha'),
+        'Referencia': CAMPOS_REGLAS['Referencia'](valores, columnas).astype('category'),
+        'Descripción': CAMPOS_REGLAS['Descripción'](valores, columnas).astype('category'),
+        'Concepto': CAMPOS_REGLAS['Concepto'](valores, columnas).astype('category'),
+        'Documento': celdas('Documento').astype('category'),
+        'Cliente / Prov.': celdas('Cliente / Prov.'),
+        'Cantidad': celdas('Cantidad'),
+        'Precio': celdas('Precio'),
+    })
+
+def procesar_xls(df, plantilla=None, cabecera=None, perfil=None, progreso=None):
+    # df es la hoja completa (DataFrame) o un iterador de filas (lectura en streaming)
+    # Cada etapa se mide en perfil (tiempo, filas de entrada y salida y memoria)
+    # progreso(filas, registros, lotes) se llama tras cada bloque (ver Tarea)
+    # Devuelve el resultado, las celdas de número o fecha que no se pudieron convertir
+    # y los agregados (KPIs y resúmenes de calcular_agregados). Los errores se
+    # propagan: los muestra main() al terminar la tarea
+    perfil = perfil or Perfil()
+    # Cada registro se cierra en la fila sin referencia que le sigue; solo
+    # se construyen (y se les busca LOT) las filas que superan los filtros
+    filtro = FiltroReglas(REGLAS, CAMPOS_REGLAS)
+    en_memoria = isinstance(df, pd.DataFrame)
+    with perfil.etapa('combinar_lotes' if en_memoria else 'lectura + combinar_lotes', len(df) if en_memoria else None) as registro:
+        df_final = combinar_tabla(df, construir_tabla, plantilla, cierre_por_fila_vacia=True, tamano_bloque=FILAS_POR_BLOQUE,
+                                  cabecera=cabecera, filtro=filtro, columna_fila=COLUMNA_FILA, progreso=progreso)
+        registro['filas_salida'] = len(df_final)
+    # Las filas de cada regla quedan en el perfil (se muestran con "Depuración")
+    filtro.registrar(perfil)
     
-    suffix = extract_suffix(referencia)
+    with perfil.etapa('limpiar concepto', len(df_final)) as registro:
+        # El concepto ya llega sin espacios de construir_tabla (un .str perdería la categoría)
+        df_final.dropna(subset=['Concepto'], inplace=True)
+        registro['filas_salida'] = len(df_final)
     
-    mapping = {
-        '10': 10.0,
-        '20': 20.0,
-        '30': 30.0,
-        '44': 0.44,
-        '33': 0.33,
-        '33C': 0.33,
-        '44C': 0.44,
-        '37': 0.37,
-        '20I': 20.0,  # Specific case for 20I
-        '30I': 30.0,  # Specific case for 30I
-        '33C': 0.33,  # Specific case for 33C
-    }
+    with perfil.etapa('reglas', len(df_final)) as registro:
+        df_final = aplicar_reglas(df_final, REGLAS)
+        registro['filas_salida'] = len(df_final)
+
+    # Fecha, cliente, cantidad y precio en una sola pasada por columna
+    with perfil.etapa('números', len(df_final)) as registro:
+        errores = convertir_columnas(df_final, COLUMNA_FILA)
+        df_final = df_final.drop(columns=COLUMNA_FILA)
+        registro['filas_salida'] = len(df_final)
+
+    with perfil.etapa('litros', len(df_final)) as registro:
+        df_final['LITRES'] = (calcular_litros(df_final['Referencia']) * df_final['Cantidad']).abs()
+        df_final['VALOR'] = (df_final['Cantidad'] * df_final['Precio']).abs()
+        registro['filas_salida'] = len(df_final)
+
+    # KPIs y resúmenes en una sola agrupación
+    with perfil.etapa('agregados', len(df_final)):
+        agregados = calcular_agregados(df_final)
     
-    return mapping.get(suffix, 0.0) if suffix else 0.0
-
-def procesar_xls(df):
-    try:
-        columnas = {
-            'Almacén': None,
-            'Fecha': None,
-            'Referencia': None,
-            'Descripción': None,
-            'Concepto': None,
-            'Documento': None,
-            'Cliente / Prov.': None,
-            'Cantidad': None,
-            'Precio': None,
-        }
-        
-        header_identified = False
-        header_row = -1
-        for idx, row in df.iterrows():
-            for col_idx, value in enumerate(row):
-                if pd.notnull(value):
-                    value_str = str(value).strip().lower()
-                    if columnas['Almacén'] is None and 'almacén' in value_str:
-                        columnas['Almacén'] = col_idx
-                    if columnas['Fecha'] is None and 'fecha' in value_str:
-                        columnas['Fecha'] = col_idx
-                    if columnas['Referencia'] is None and 'referencia' in value_str:
-                        columnas['Referencia'] = col_idx
-                    if columnas['Descripción'] is None and 'descripción' in value_str:
-                        columnas['Descripción'] = col_idx
-                    if columnas['Concepto'] is None and 'concepto' in value_str:
-                        columnas['Concepto'] = col_idx
-                    if columnas['Documento'] is None and 'documento' in value_str:
-                        columnas['Documento'] = col_idx
-                    if columnas['Cliente / Prov.'] is None and 'cliente' in value_str and 'prov' in value_str:
-                        columnas['Cliente / Prov.'] = col_idx
-                    if columnas['Cantidad'] is None and 'cantidad' in value_str:
-                        columnas['Cantidad'] = col_idx
-                    if columnas['Precio'] is None and 'precio' in value_str:
-                        columnas['Precio'] = col_idx
-            
-            if all(col is not None for col in columnas.values()):
-                header_row = idx
-                header_identified = True
-                break
-        
-        if not header_identified:
-            raise ValueError("No se pudieron identificar todas las columnas necesarias.")
-        
-        filas_combinadas = []
-        temp_fila = None
-        lot = None
-        
-        header_pattern = re.compile(r'^(movimientos:|almacén|página|fecha|referencia)', re.IGNORECASE)
-        
-        for index, row in df.iterrows():
-            if pd.isnull(row[columnas['Referencia']]):
-                if temp_fila is not None:
-                    temp_fila['LOT'] = lot if lot else ''
-                    filas_combinadas.append(temp_fila)
-                    temp_fila = None
-                    lot = None
-            else:
-                descripcion = str(row[columnas['Descripción']])
-                try:
-                    descripcion += " " + str(df.iat[index, columnas['Descripción'] + 1])
-                except:
-                    pass
-                
-                concepto = str(row[columnas['Concepto']]).strip()
-                try:
-                    concepto += " " + str(df.iat[index, columnas['Concepto'] + 1]).strip()
-                except:
-                    pass
-                
-                cliente = 0
-                try:
-                    cliente_str = str(row[columnas['Cliente / Prov.']]).replace("nan", "0").replace(",", ".")
-                    cliente = int(float(cliente_str))
-                except:
-                    pass
-                
-                cantidad = 0.0
-                try:
-                    cantidad_str = str(row[columnas['Cantidad']]).replace(",", ".").strip()
-                    cantidad = float(cantidad_str)
-                except:
-                    pass
-                
-                precio = 0.0
-                try:
-                    precio_str = str(row[columnas['Precio']]).replace(",", ".").strip()
-                    precio = float(precio_str)
-                except:
-                    pass
-                
-                current_almacen = row[columnas['Almacén']]
-                current_fecha = row[columnas['Fecha']]
-                current_documento = row[columnas['Documento']]
-                
-                current_ref_col = columnas['Referencia']
-                current_ref = str(row[current_ref_col]).strip().upper() if pd.notnull(row[current_ref_col]) else ''
+    return df_final, errores, agregados
 
-                lot = None
-                lot_found = False
-                for next_index in range(index + 1, len(df)):
-                    next_row = df.iloc[next_index]
-                    
-                    current_row_str = ''
-                    for col in range(df.shape[1]):
-                        value = next_row[col]
-                        if pd.notnull(value):
-                            current_row_str = str(value).strip()
-                            break
-                    
-                    if header_pattern.search(current_row_str) or current_row_str == '':
-                        continue
-                    
-                    next_ref_col = columnas['Referencia']
-                    next_ref = str(next_row[next_ref_col]).strip().lower() if pd.notnull(next_row[next_ref_col]) else ''
+# ------------------------------------------------------------------------ #
+# CACHÉ POR CONTENIDO DEL ARCHIVO
+# Streamlit vuelve a ejecutar el script en cada interacción: la lectura, el
+# procesamiento y el Excel de descarga se guardan por huella (SHA-256) del
+# archivo subido, con un número máximo de entradas y caducidad. Junto a cada
+# resultado se guardan las etapas medidas en la ejecución que lo calculó.
+MAX_ARCHIVOS_CACHE = 4
+TTL_CACHE = 60 * 60
 
-                    if next_ref and next_ref.startswith('e') and next_ref != current_ref.lower() and not lot_found:
-                        break
-                    
-                    local_lot = None
-                    for col in range(df.shape[1]):
-                        lot_cell = str(next_row[col]).strip().upper()
-                        match = re.search(r'(\d{2}[-\s]\d{3})', lot_cell)
-                        if match:
-                            local_lot = re.sub(r'\s+', '', match.group(1))
-                            break
-                    
-                    if local_lot:
-                        lot = local_lot
-                        lot_found = True
-                        break
-
-                temp_fila = {
-                    'Almacén': current_almacen,
-                    'Fecha': current_fecha,
-                    'Referencia': current_ref,
-                    'Descripción': descripcion.replace("nan", "").strip(),
-                    'Concepto': concepto.replace("nan", "").strip(),
-                    'Documento': current_documento,
-                    'Cliente / Prov.': cliente,
-                    'Cantidad': abs(cantidad),
-                    'Precio': abs(precio),
-                    'LOT': lot if lot else '',
-                }
-        
-        df_final = pd.DataFrame(filas_combinadas)
+def huella_archivo(uploaded_file):
+    # El hash se calcula una vez por subida (por trozos, sin copiar el
+    # contenido) y se guarda en la sesión
+    huellas = st.session_state.setdefault('huellas', {})
+    if uploaded_file.file_id not in huellas:
+        huellas[uploaded_file.file_id] = huella_fichero(uploaded_file)
+    return huellas[uploaded_file.file_id]
 
-        # debug
-        st.write("Conceptos detectados:")
-        st.write(df_final['Concepto'].value_counts())
+# ------------------------------------------------------------------------ #
+# ARCHIVOS GRANDES EN DISCO
+# Las subidas de más de UMBRAL_SUBIDA_MB se copian por trozos a un archivo
+# temporal y se leen desde ahí (xlrd proyecta el .xls en memoria con mmap y
+# openpyxl lee el .xlsx por partes), en lugar de pasar copias del contenido.
+# El Excel de descarga se escribe una vez en disco y se sirve desde el
+# archivo. Los temporales se borran al caducar, como la caché.
+UMBRAL_SUBIDA_MB = 20
+DIRECTORIO_TEMPORAL = os.path.join(tempfile.gettempdir(), 'silice_app')
 
-        st.subheader("Valores únicos de la columna Concepto (antes de filtrar)")
-        st.write(df_final['Concepto'].dropna().unique())
+def escribir_temporal(ruta, escribir):
+    # Escritura atómica: otra sesión puede estar generando el mismo archivo
+    os.makedirs(DIRECTORIO_TEMPORAL, exist_ok=True)
+    escribir_atomico(ruta, escribir)
+    limpiar_temporales()
 
-        st.write("Intercambios antes de filtros:", df_final[df_final['Concepto'].str.contains('intercambio', case=False, na=False)].shape[0])
-        st.write("Intercambios antes filtros ABV/ref:", (df_final['Concepto'].str.lower() == 'salida por intercambio').sum())
-        # end debug
-        
-        df_final.dropna(subset=['Concepto'], inplace=True)
-        df_final['Concepto'] = df_final['Concepto'].str.strip()
-        
-        # 1) Incluir también "Salida por Intercambio"
-        df_final = df_final[df_final['Concepto'].isin(['Salida por Factura', 'Entrada por abono en Factura', 'Salida por Intercambio'])]
+def limpiar_temporales():
+    limite = time.time() - TTL_CACHE
+    for entrada in os.scandir(DIRECTORIO_TEMPORAL):
+        try:
+            if entrada.stat().st_mtime < limite:
+                os.remove(entrada.path)
+        except OSError:
+            pass
 
-        
-        # Debug tras filtro de Concepto
-        df_tmp = df_final[df_final['Concepto'].str.contains('factura|intercambio', case=False, na=False)]
-        st.write("Tras filtro Concepto:", df_tmp.shape[0])
+def copiar_subida(uploaded_file, destino):
+    uploaded_file.seek(0)
+    with open(destino, 'wb') as f:
+        shutil.copyfileobj(uploaded_file, f, 1 << 20)
 
-        # 2) Forzar Cliente=2734 SOLO para "Salida por Intercambio"
-        mask_intercambio = df_final['Concepto'].str.strip().str.lower().eq('salida por intercambio')
-        df_final.loc[mask_intercambio, 'Cliente / Prov.'] = 2734
+def origen_subida(uploaded_file, huella, extension):
+    # Ruta del archivo en disco para las subidas grandes, el contenido para el resto
+    if uploaded_file.size <= UMBRAL_SUBIDA_MB * 2**20:
+        return uploaded_file.getvalue()
+    ruta = os.path.join(DIRECTORIO_TEMPORAL, f"{huella}{extension}")
+    if os.path.exists(ruta):
+        os.utime(ruta)
+    else:
+        escribir_temporal(ruta, lambda temporal: copiar_subida(uploaded_file, temporal))
+    return ruta
 
-        df_final = df_final[df_final['Descripción'].str.contains('ABV', case=False, na=False)]
+def abrir_origen(origen):
+    return origen if isinstance(origen, str) else BytesIO(origen)
 
-        # Debug Tras ABV
-        df_tmp = df_tmp[df_tmp['Descripción'].str.contains('ABV', case=False, na=False)]
-        st.write("Tras filtro ABV:", df_tmp.shape[0])
+@st.cache_data(max_entries=MAX_ARCHIVOS_CACHE, ttl=TTL_CACHE, show_spinner="Procesando datos...")
+def procesar_archivo(huella, extension, streaming, plantilla, medir_memoria, _origen, _progreso=None, _nombre=None):
+    # _origen es la ruta del temporal o el contenido de la subida (ver
+    # origen_subida); ni él, ni _progreso (una Tarea), ni _nombre (el nombre
+    # del archivo subido, que se guarda en el índice de trazabilidad) forman
+    # parte de la clave
+    perfil = Perfil(memoria=medir_memoria)
+    if _progreso is not None and _progreso.cancelar.is_set():
+        # Cancelada mientras esperaba en el grupo: ni siquiera se lee el archivo
+        raise ProcesoCancelado()
+    if streaming:
+        origen = iterar_filas(abrir_origen(_origen), extension)
+        cabecera = None
+    else:
+        # La hoja leída y su cabecera se guardan en disco (caché compartida con
+        # la CLI), así que no se vuelve a analizar el archivo; la cabecera se
+        # guarda con el nombre de la plantilla, o se toma de ella si ya existe
+        origen, cabecera = leer_hoja(abrir_origen(_origen), plantilla, cache=CacheHojas(), huella=huella, perfil=perfil)
+        if _progreso is not None:
+            _progreso.total = len(origen)
+            _progreso(0, 0, 0)
+    df_final, errores, agregados = procesar_xls(origen, plantilla, cabecera, perfil, _progreso)
+    # Los movimientos con LOT se añaden al índice de trazabilidad (pestaña
+    # "Trazabilidad de LOTs"); si no se puede, el resultado se muestra igual
+    with perfil.etapa('trazabilidad', len(df_final)) as registro:
+        try:
+            registro['filas_salida'] = IndiceTrazabilidad(ARCHIVO_TRAZABILIDAD).actualizar(df_final, _nombre)
+        except Exception as e:
+            warnings.warn(f"No se pudo actualizar el índice de trazabilidad: {e}")
+    return df_final, errores, agregados, perfil.etapas
 
-        df_final = df_final[df_final['Referencia'].str.lower().str.startswith('e', na=False)]
-        
-        # Debug Tras referencia e
-        df_tmp = df_tmp[df_tmp['Referencia'].str.lower().str.startswith('e', na=False)]
-        st.write("Tras filtro Referencia e:", df_tmp.shape[0])
+# Formatos de descarga: el Excel lleva formato y resúmenes; Parquet y CSV
+# solo las columnas procesadas, para cargarlas en otras herramientas
+FORMATOS_DESCARGA = {
+    "Excel": ('xlsx', "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "Parquet": ('parquet', "application/vnd.apache.parquet"),
+    "CSV": ('csv', "text/csv"),
+}
 
-        df_final['LITRES'] = (df_final.apply(lambda row: get_litres_referencia(row['Referencia'], row['Concepto']), axis=1) * df_final['Cantidad']).abs()
-        df_final['VALOR'] = (df_final['Cantidad'] * df_final['Precio']).abs()
-        
-        return df_final
+@st.cache_data(max_entries=MAX_ARCHIVOS_CACHE, ttl=TTL_CACHE, show_spinner="Generando archivo de descarga...")
+def generar_descarga(huella, formato, streaming, plantilla, medir_memoria, _df_processed, _resumenes):
+    # En xlsx, cabecera fija, filtros y formatos en una sola escritura, con una
+    # hoja por resumen; siempre directamente a un archivo temporal, cuya ruta
+    # se devuelve
+    perfil = Perfil(memoria=medir_memoria)
+    opciones = hashlib.sha256(repr((streaming, plantilla)).encode()).hexdigest()[:12]
+    ruta = os.path.join(DIRECTORIO_TEMPORAL, f"{huella}_{opciones}.{formato}")
+    with perfil.etapa('escritura', len(_df_processed)):
+        escribir_temporal(ruta, lambda temporal: escribir_salida(_df_processed, temporal, formato, hojas_extra=_resumenes))
+    return ruta, perfil.etapas
+
+# ------------------------------------------------------------------------ #
+# PROCESAMIENTO EN SEGUNDO PLANO
+# "Procesar Datos" lanza procesar_archivo en un hilo de un grupo compartido
+# por todas las sesiones del servidor: la interfaz sigue respondiendo, se
+# puede cancelar y los archivos grandes no se procesan todos a la vez
+MAX_PROCESOS_SIMULTANEOS = 2
+FILAS_POR_BLOQUE = 10_000
+REFRESCO_PROGRESO = 0.5
+
+class ProcesoCancelado(Exception):
+    pass
+
+@st.cache_resource
+def grupo_procesos():
+    return ThreadPoolExecutor(max_workers=MAX_PROCESOS_SIMULTANEOS, thread_name_prefix='silice')
+
+class Tarea:
+    # Procesamiento de una sesión: el motor la llama tras cada bloque con las
+    # filas leídas, los registros completados y cuántos tienen LOT, y ahí se
+    # interrumpe si se ha pedido cancelar. El resultado queda en la caché y,
+    # al terminar, en la sesión
+    def __init__(self, clave, *argumentos, **opciones):
+        self.clave = clave
+        self.cancelar = threading.Event()
+        self.total = None
+        self.filas = self.registros = self.lotes = 0
+        self.futuro = grupo_procesos().submit(procesar_archivo, *argumentos, _progreso=self, **opciones)
+
+    def detener(self):
+        # Si aún no ha empezado sale del grupo; si no, se interrumpe en el
+        # siguiente bloque
+        self.cancelar.set()
+        self.futuro.cancel()
+
+    def __call__(self, filas, registros, lotes):
+        if self.cancelar.is_set():
+            raise ProcesoCancelado()
+        self.filas, self.registros, self.lotes = filas, registros, lotes
+
+@st.fragment(run_every=REFRESCO_PROGRESO)
+def mostrar_progreso(tarea):
+    # Solo este fragmento se vuelve a ejecutar mientras la tarea sigue en marcha
+    if tarea.futuro.done():
+        st.rerun()
+    if tarea.cancelar.is_set():
+        texto = "Cancelando..."
+    elif not tarea.futuro.running():
+        texto = "En espera: otros archivos se están procesando en el servidor..."
+    elif tarea.filas == 0:
+        texto = "Leyendo el archivo..."
+    else:
+        texto = f"{tarea.filas:,} filas leídas · {tarea.registros:,} registros · {tarea.lotes:,} con LOT"
+    if tarea.total:
+        st.progress(min(tarea.filas / tarea.total, 1.0), text=texto)
+    else:
+        st.progress(0, text=texto)
+    if st.button("Cancelar", disabled=tarea.cancelar.is_set()):
+        tarea.detener()
+
+def mostrar_rendimiento(etapas):
+    # Panel plegable con la medición de cada etapa; las subetapas (cada filtro
+    # dentro de combinar_lotes) van sangradas y no suman al total
+    with st.expander("Rendimiento"):
+        filas = [{**etapa, 'etapa': f"  └ {etapa['etapa']}"} if etapa.get('subetapa') else etapa for etapa in etapas]
+        tabla = pd.DataFrame(filas, columns=Perfil.COLUMNAS).rename(columns={
+            'etapa': 'Etapa', 'segundos': 'Tiempo (s)', 'filas_entrada': 'Filas entrada',
+            'filas_salida': 'Filas salida', 'pico_mb': 'Pico memoria (MB)',
+        })
+        st.dataframe(tabla, hide_index=True)
+        st.caption(f"Tiempo total: {Perfil.total(etapas):.2f} s. Los resultados que salen de la caché muestran la medición de la ejecución que los calculó.")
+
+def mostrar_depuracion(etapas):
+    # Filas que supera cada filtro, tal como se contaron al procesar
+    nombres = {regla.nombre for regla in REGLAS}
+    for etapa in etapas:
+        if etapa['etapa'] in nombres:
+            st.write(f"Tras {etapa['etapa']}:", etapa['filas_salida'], f"(de {etapa['filas_entrada']})")
+
+# ------------------------------------------------------------------------ #
+# VISTA DEL RESULTADO: FILTRADA Y PAGINADA EN EL SERVIDOR
+# Solo la página visible se envía al navegador; las opciones de los filtros
+# salen de los resúmenes ya calculados
+FILAS_POR_PAGINA = [25, 50, 100, 250]
+
+def filtrar_tabla(df, conceptos, referencias, lote, clientes):
+    mascara = pd.Series(True, index=df.index)
+    if conceptos:
+        mascara &= df['Concepto'].isin(conceptos)
+    if referencias:
+        mascara &= df['Referencia'].isin(referencias)
+    if lote:
+        mascara &= df['LOT'].str.contains(lote, case=False, regex=False, na=False)
+    if clientes:
+        mascara &= df['Cliente / Prov.'].isin(clientes)
+    return df[mascara]
+
+def mostrar_tabla(df, resumenes):
+    col1, col2 = st.columns(2)
+    with col1:
+        conceptos = st.multiselect("Concepto", resumenes['Por concepto']['Concepto'].tolist())
+    with col2:
+        referencias = st.multiselect("Referencia", resumenes['Por referencia']['Referencia'].tolist())
+    col3, col4 = st.columns(2)
+    with col3:
+        lote = st.text_input("LOT contiene").strip()
+    with col4:
+        clientes = st.multiselect("Cliente / Prov.", resumenes['Por cliente']['Cliente / Prov.'].tolist())
     
-    except Exception as e:
-        st.error(f"Error durante el procesamiento: {e}")
-        return pd.DataFrame()
+    filtrado = filtrar_tabla(df, conceptos, referencias, lote, clientes)
+    col5, col6 = st.columns(2)
+    with col5:
+        filas_pagina = st.selectbox("Filas por página", FILAS_POR_PAGINA, index=1)
+    paginas = max(1, -(-len(filtrado) // filas_pagina))
+    with col6:
+        # Al cambiar los filtros cambia el máximo y la página vuelve a la primera
+        pagina = st.number_input(f"Página (de {paginas})", min_value=1, max_value=paginas, value=1, step=1)
+    
+    inicio = (pagina - 1) * filas_pagina
+    st.dataframe(filtrado.iloc[inicio:inicio + filas_pagina], width=1000, hide_index=True)
+    if len(filtrado):
+        st.caption(f"Filas {inicio + 1}-{min(inicio + filas_pagina, len(filtrado))} de {len(filtrado)} ({len(df)} en total).")
+    else:
+        st.caption(f"Ninguna fila cumple los filtros ({len(df)} en total).")
 
 # ------------------------------------------------------------------------ #
-# CONFIGURACIÓN DE LA VISTA EN STREAMLIT
-def main():
-    st.set_page_config(
-        page_title="SILICE - Procesador de Excel",
-        page_icon="📈",
-    )
+# TRAZABILIDAD DE LOTS
+# Consultas al índice SQLite que llenan esta aplicación y el procesador de
+# línea de comandos: no se vuelve a leer ningún Excel
+@st.cache_data(ttl=60, show_spinner=False)
+def resumen_trazabilidad():
+    return IndiceTrazabilidad(ARCHIVO_TRAZABILIDAD).resumen()
 
-    st.title("Aplicación SILICE")
+def pestana_trazabilidad():
+    st.subheader("Trazabilidad de LOTs")
+    if not os.path.exists(ARCHIVO_TRAZABILIDAD):
+        st.info("El índice de trazabilidad está vacío: se llena al procesar exportaciones (aquí o con el procesador de línea de comandos).")
+        return
+    
+    indice = IndiceTrazabilidad(ARCHIVO_TRAZABILIDAD)
+    resumen = resumen_trazabilidad()
+    st.caption(f"{resumen['filas']} movimientos de {resumen['lotes']} LOTs y {resumen['clientes']} clientes "
+               f"(del {resumen['desde']} al {resumen['hasta']}).")
+    
+    busqueda = st.radio("Buscar", ["Clientes de un LOT", "LOTs de un cliente"], horizontal=True)
+    if busqueda == "Clientes de un LOT":
+        lote = st.text_input("LOT", placeholder="24-118").strip()
+        if not lote:
+            return
+        resultado, buscado, agrupado = indice.clientes_de_lote(lote), f"del LOT {lote}", 'Cliente / Prov.'
+    else:
+        cliente = st.number_input("Cliente / Prov.", min_value=0, step=1, value=None)
+        if cliente is None:
+            return
+        resultado, buscado, agrupado = indice.lotes_de_cliente(cliente), f"del cliente {cliente}", 'LOT'
+    
+    if resultado.empty:
+        st.warning(f"No hay movimientos {buscado} en el índice.")
+        return
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Clientes" if agrupado == 'Cliente / Prov.' else "LOTs", resultado[agrupado].nunique())
+    with col2:
+        st.metric("Movimientos", int(resultado['Movimientos'].sum()))
+    with col3:
+        st.metric("LITRES", f"{resultado['LITRES'].sum():,.2f}")
+    st.dataframe(resultado, hide_index=True)
+
+# ------------------------------------------------------------------------ #
+# CONFIGURACIÓN DE LA VISTA EN STREAMLIT
+def pestana_procesar():
     st.subheader("Procesar Archivos Excel")
     st.write("---")
 
     uploaded_file = st.file_uploader("Sube un archivo Excel", type=["xls", "xlsx"])
+    streaming = st.checkbox("Lectura en streaming (archivos grandes)", help="Lee el libro fila a fila sin cargar toda la hoja en memoria.")
+    medir_memoria = st.checkbox("Medir memoria por etapa", help="Añade el pico de memoria al panel de rendimiento (el procesamiento es más lento).")
+    depurar = st.toggle("Depuración", help="Muestra cuántas filas supera cada filtro.")
 
     if uploaded_file:
-        try:
-            if uploaded_file.name.endswith('.xls'):
-                df = pd.read_excel(uploaded_file, engine="xlrd")
+        extension = os.path.splitext(uploaded_file.name)[1].lower()
+        huella = huella_archivo(uploaded_file)
+        origen = origen_subida(uploaded_file, huella, extension)
+        
+        plantilla = st.text_input("Plantilla de exportación (opcional)", help="Guarda la cabecera detectada con este nombre para omitir la detección la próxima vez.") or None
+        
+        # El resultado de la tarea se guarda en la sesión y sigue visible en las
+        # siguientes interacciones aunque la caché lo haya descartado: el
+        # procesamiento solo se hace dentro de una Tarea
+        clave = (huella, streaming, plantilla, medir_memoria)
+        tarea = st.session_state.get('tarea')
+        if tarea is not None and (tarea.clave != clave or tarea.futuro.done()):
+            del st.session_state['tarea']
+            if tarea.clave != clave:
+                # Han cambiado el archivo o las opciones: la tarea anterior ya no se mostrará
+                tarea.detener()
             else:
-                df = pd.read_excel(uploaded_file, engine="openpyxl")
-        except Exception as e:
-            st.error(f"Error al leer el archivo: {e}")
+                try:
+                    st.session_state['resultado'] = (clave, tarea.futuro.result())
+                except (ProcesoCancelado, CancelledError):
+                    st.info("Procesamiento cancelado.")
+                except Exception as e:
+                    st.error(f"Error durante el procesamiento: {e}")
+            tarea = None
+        
+        if st.button("Procesar Datos", disabled=tarea is not None):
+            tarea = st.session_state['tarea'] = Tarea(clave, huella, extension, streaming, plantilla, medir_memoria, origen,
+                                                        _nombre=uploaded_file.name)
+            st.session_state['resultado'] = None
+        
+        if tarea is not None:
+            mostrar_progreso(tarea)
             return
         
-        if st.button("Procesar Datos"):
-            df_processed = procesar_xls(df)
+        resultado = st.session_state.get('resultado')
+        if resultado is not None and resultado[0] == clave:
+            df_processed, errores, (indicadores, resumenes), etapas = resultado[1]
             if not df_processed.empty:
                 st.success("Datos procesados satisfactoriamente!")
+                if depurar:
+                    mostrar_depuracion(etapas)
                 
-                # Mostrar KPIs
+                # Mostrar KPIs (precalculados con el resultado)
+                por_concepto = indicadores['por_concepto']
                 col1, col2, col3 = st.columns(3)
                 with col1:
-                    st.metric("Total de Registros", df_processed.shape[0])
+                    st.metric("Total de Registros", indicadores['registros'])
                 with col2:
-                    st.metric("Registros sin LOTE", (df_processed['LOT'] == '').sum())
+                    st.metric("Registros sin LOTE", indicadores['sin_lote'])
                 with col3:
-                    st.metric("Total de Referencias Únicas", df_processed['Referencia'].nunique())
+                    st.metric("Total de Referencias Únicas", indicadores['referencias'])
 
                 # Mostrar KPIs
                 col4, col5, col6 = st.columns(3)
                 with col4:
-                    st.metric("Registros: Salida por Factura", (df_processed['Concepto'].str.lower() == 'salida por factura').sum())
+                    st.metric("Registros: Salida por Factura", por_concepto.get('salida por factura', 0))
                 with col5:
-                    st.metric("Registros: Entrada por abono en Factura", (df_processed['Concepto'].str.lower() == 'entrada por abono en factura').sum())
+                    st.metric("Registros: Entrada por abono en Factura", por_concepto.get('entrada por abono en factura', 0))
                 with col6:
-                    st.metric("Registros: Salida por intercambio", (df_processed['Concepto'].str.lower() == 'salida por intercambio').sum())
+                    st.metric("Registros: Salida por intercambio", por_concepto.get('salida por intercambio', 0))
+                    
+                # Celdas de fecha, cliente, cantidad o precio que no se pudieron leer
+                if not errores.empty:
+                    st.warning(f"{len(errores)} celdas no válidas: los números se han tomado como 0 y las fechas han quedado vacías.")
+                    with st.expander("Valores no válidos"):
+                        st.dataframe(errores, hide_index=True)
                     
                 st.subheader("Datos Procesados:")
-                st.data_editor(df_processed, width=1000)
+                mostrar_tabla(df_processed, resumenes)
                 
-                st.subheader("Descarga el Archivo:")
-                output = BytesIO()
-                with pd.ExcelWriter(output, engine="openpyxl") as writer:
-                    df_processed.to_excel(writer, sheet_name="Resultado", index=False)
+                # Resúmenes por referencia, LOT, cliente, concepto y mes (también en el Excel)
+                with st.expander("Resúmenes"):
+                    for hoja, resumen in resumenes.items():
+                        st.write(hoja)
+                        st.dataframe(resumen, hide_index=True)
                 
-                # Aplicar estilos con openpyxl
-                wb = load_workbook(output)
-                ws = wb.active
-                ws.freeze_panes = "A2"
-                ws.auto_filter.ref = ws.dimensions
+                st.subheader("Descarga el Archivo:")
+                nombre_formato = st.radio("Formato", list(FORMATOS_DESCARGA), horizontal=True,
+                                          help="Excel con formato y resúmenes; Parquet o CSV solo con las columnas, para cargarlas en otras herramientas.")
+                formato, mime = FORMATOS_DESCARGA[nombre_formato]
+                ruta_descarga, etapas_escritura = generar_descarga(huella, formato, streaming, plantilla, medir_memoria, df_processed, resumenes)
+                if not os.path.exists(ruta_descarga):
+                    # El temporal caducó antes que la caché: se vuelve a escribir
+                    generar_descarga.clear()
+                    ruta_descarga, etapas_escritura = generar_descarga(huella, formato, streaming, plantilla, medir_memoria, df_processed, resumenes)
                 
-                # Guardar y resetear el búfer
-                output = BytesIO()
-                wb.save(output)
-                output.seek(0)
+                with open(ruta_descarga, 'rb') as descarga:
+                    st.download_button(
+                        label=f"Descargar {nombre_formato} Procesado",
+                        data=descarga,
+                        file_name=f"Processed_Output.{formato}",
+                        mime=mime
+                    )
                 
-                st.download_button(
-                    label="Descargar Excel Procesado",
-                    data=output,
-                    file_name="Processed_Output.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
+                mostrar_rendimiento(etapas + etapas_escritura)
             else:
                 st.warning("No se encontraron datos para procesar. Verifica los criterios y el formato del archivo.")
+                if depurar:
+                    mostrar_depuracion(etapas)
+                mostrar_rendimiento(etapas)
 
-if __name__ == '__main__':
-    main()
-
-
-
-
+def main():
+    st.set_page_config(
+        page_title="SILICE - Procesador de Excel",
+        page_icon="📈",
+    )
 
+    st.title("Aplicación SILICE")
+    procesar, trazabilidad = st.tabs(["Procesar", "Trazabilidad de LOTs"])
+    with procesar:
+        pestana_procesar()
+    with trazabilidad:
+        pestana_trazabilidad()
 
+if __name__ == '__main__':
+    main()